@@ -186,6 +186,10 @@ class MLMaxTrainingStep(Task):
         sm_region=None,
         sm_output_data=None,
         sm_debug_output_data=None,
+        train_distribution="FullyReplicated",
+        checkpoint_s3_uri=None,
+        use_spot_instances=False,
+        max_wait=None,
         **kwargs,
     ):
         """
@@ -236,6 +240,21 @@ class MLMaxTrainingStep(Task):
             tags (list[dict], optional): `List to tags
             <https://docs.aws.amazon.com/sagemaker/latest/dg/API_Tag.html>`_ to
             associate with the resource.
+            train_distribution (str, optional): `S3DataDistributionType` of the
+            train channel. Use 'ShardedByS3Key' with several training
+            instances to give each host its own share of the `part-*` files,
+            for the data-parallel training of train.py, which then needs a
+            random `averaging-token` in `hyperparameters`. The test channel
+            is always 'FullyReplicated'. (default: 'FullyReplicated')
+            checkpoint_s3_uri (str or Placeholder, optional): S3 URI synced
+            with /opt/ml/checkpoints, where train.py saves checkpoints to
+            resume from when the job restarts. (default: None)
+            use_spot_instances (bool, optional): Use managed spot training.
+            Combine with `checkpoint_s3_uri` so that interruptions resume
+            rather than restart training. (default: False)
+            max_wait (int, optional): Maximum seconds to wait for spot
+            capacity and training, at least the estimator's `max_run`.
+            (default: `max_run` with spot instances)
         """
         self.estimator = estimator
         self.job_name = job_name
@@ -271,7 +290,7 @@ class MLMaxTrainingStep(Task):
                             "S3DataSource": {
                                 "S3DataType": "S3Prefix",
                                 "S3Uri": train_data,
-                                "S3DataDistributionType": "FullyReplicated",
+                                "S3DataDistributionType": train_distribution,
                             }
                         },
                         "ChannelName": "train",
@@ -288,6 +307,19 @@ class MLMaxTrainingStep(Task):
                     },
                 ]
 
+        if checkpoint_s3_uri is not None:
+            parameters["CheckpointConfig"] = {
+                "S3Uri": checkpoint_s3_uri,
+                "LocalPath": "/opt/ml/checkpoints",
+            }
+
+        if use_spot_instances:
+            parameters["EnableManagedSpotTraining"] = True
+            stopping_condition = parameters.setdefault("StoppingCondition", {})
+            stopping_condition["MaxWaitTimeInSeconds"] = (
+                max_wait or stopping_condition["MaxRuntimeInSeconds"]
+            )
+
         if sm_output_data is not None:
             parameters["OutputDataConfig"]["S3OutputPath"] = sm_output_data
 
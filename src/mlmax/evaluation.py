@@ -1,35 +1,274 @@
 import argparse
+import glob
+import hashlib
 import json
 import os
+import shutil
 import tarfile
+import tempfile
+from collections import OrderedDict
 
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
 try:
     from sklearn.externals import joblib
 except ImportError:
     import joblib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 from sklearn.metrics import accuracy_score, classification_report, roc_auc_score
 
+feature_extensions = {
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "feather": ".feather",
+    "npy": ".npy",
+    "npz": ".npz",
+}
+
+
+artifact_cache_dir = os.environ.get(
+    "MLMAX_ARTIFACT_CACHE",
+    os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "mlmax-artifacts",
+    ),
+)
+artifact_cache_size = 4
+_artifact_cache = OrderedDict()
+_artifact_digests = {}
+
+
+def read_matrix(path, feature_format="csv", dense=False, dtype=None):
+    """
+    Read a headerless feature or label file written by preprocessing.py,
+    cast to `dtype` if given.
+
+    Sparse `npz` files are returned as CSR matrices unless `dense` is set.
+    CSV files may be compressed with gzip (`.gz`) or zstd (`.zst`).
+    """
+    if feature_format == "npz":
+        X = sparse.load_npz(path)
+        if dtype is not None:
+            X = X.astype(dtype, copy=False)
+        return pd.DataFrame(X.toarray()) if dense else X
+    if feature_format == "csv" and path.endswith(".zst"):
+        with open(path, "rb") as f:
+            reader = zstandard.ZstdDecompressor().stream_reader(
+                f, read_across_frames=True
+            )
+            return pd.read_csv(reader, header=None, dtype=dtype)
+    if feature_format == "csv":
+        return pd.read_csv(path, header=None, dtype=dtype)
+    if feature_format == "npy":
+        X = np.load(path)
+        return pd.DataFrame(X if dtype is None else X.astype(dtype, copy=False))
+    df = getattr(pd, f"read_{feature_format}")(path)
+    df.columns = range(df.shape[1])
+    return df if dtype is None else df.astype(dtype, copy=False)
+
+
+def with_compression(path):
+    """`path`, or the compressed file written in its place."""
+    for suffix in ["", ".gz", ".zst"]:
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return path
+
+
+def is_sharded(data_dir, split, feature_format="csv"):
+    """
+    Whether a split was written as `part-*` shards by `--output-shards`
+    rather than as `{split}_features` and `{split}_labels` files. A directory
+    holding both, as left by runs with different `--output-shards`, is
+    refused rather than read as either.
+    """
+    ext = feature_extensions[feature_format]
+    features_path = with_compression(os.path.join(data_dir, f"{split}_features{ext}"))
+    has_features = os.path.exists(features_path)
+    has_shards = os.path.exists(
+        os.path.join(data_dir, f"{split}_manifest.json")
+    ) or bool(glob.glob(os.path.join(data_dir, f"part-*{ext}*")))
+    if has_features and has_shards:
+        raise ValueError(
+            f"{data_dir} holds both {os.path.basename(features_path)} and part-*"
+            " shards of different runs"
+        )
+    return not has_features
+
+
+def shard_paths(data_dir, split, feature_format="csv"):
+    """
+    The non-empty `part-*` files of a sharded split as `(path, rows)` pairs,
+    and whether they hold the label in their first column. The shards listed
+    in the manifest of the split are checked against their checksums, and
+    unlisted ones ignored. With ShardedByS3Key, a host may receive only some
+    of the shards and no manifest, and then reads every shard it received.
+    """
+    ext = feature_extensions[feature_format]
+    manifest_path = os.path.join(data_dir, f"{split}_manifest.json")
+    if not os.path.exists(manifest_path):
+        paths = sorted(glob.glob(os.path.join(data_dir, f"part-*{ext}*")))
+        return [(path, None) for path in paths if os.path.getsize(path)], True
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    shards = []
+    for shard in manifest["shards"]:
+        path = os.path.join(data_dir, shard["file"])
+        if not shard["rows"] or not os.path.exists(path):
+            continue
+        if file_digest(path) != shard["sha256"]:
+            raise ValueError(f"Checksum of {path} does not match {manifest_path}")
+        shards.append((path, shard["rows"]))
+    return shards, manifest.get("labels", True)
+
+
+def read_shards(data_dir, split, feature_format="csv", dtype=None):
+    """
+    Read the `part-*` files of a split written with `--output-shards`, which
+    hold the label in the first column followed by the features. The labels
+    are None if the split was written without any.
+    """
+    shards, has_labels = shard_paths(data_dir, split, feature_format)
+    parts = []
+    for path, rows in shards:
+        part = read_matrix(path, feature_format, dtype=dtype)
+        if rows is not None and part.shape[0] != rows:
+            raise ValueError(f"{path} has {part.shape[0]} rows, not {rows}")
+        parts.append(part)
+    if not parts:
+        raise ValueError(
+            f"No non-empty {split} shards in {data_dir}; with ShardedByS3Key,"
+            " use at most as many hosts as there are shards"
+        )
+    if sparse.issparse(parts[0]):
+        data = sparse.vstack(parts, format="csr")
+    else:
+        data = pd.concat(parts, ignore_index=True)
+    if not has_labels:
+        return data, None
+    if sparse.issparse(data):
+        X, y = data[:, 1:], pd.DataFrame(data[:, 0].toarray())
+    else:
+        X, y = data.iloc[:, 1:], data.iloc[:, [0]]
+        X.columns = range(X.shape[1])
+        y.columns = [0]
+    return X, y.astype("int64")
+
+
+def with_format(path, feature_format):
+    return os.path.splitext(path)[0] + feature_extensions[feature_format]
+
 
 def read_features(args):
     print("Loading test input data")
-    test_features_data = os.path.join(args.data_dir, args.features_input)
-    test_labels_data = os.path.join(args.data_dir, args.labels_input)
-    X_test = pd.read_csv(test_features_data, header=None)
-    y_test = pd.read_csv(test_labels_data, header=None)
+    feature_format = args.feature_format
+    test_features_data = with_compression(
+        with_format(os.path.join(args.data_dir, args.features_input), feature_format)
+    )
+    test_labels_data = with_compression(
+        with_format(os.path.join(args.data_dir, args.labels_input), feature_format)
+    )
+    data_dir, file_name = os.path.split(test_features_data)
+    split = file_name.split("_features")[0]
+    if is_sharded(data_dir, split, feature_format):
+        X_test, y_test = read_shards(data_dir, split, feature_format, args.dtype)
+        if y_test is None:
+            raise ValueError(f"The {split} shards in {data_dir} have no labels")
+        return X_test, y_test
+    X_test = read_matrix(test_features_data, feature_format, dtype=args.dtype)
+    y_test = read_matrix(test_labels_data, feature_format, dense=True)
     return X_test, y_test
 
 
-def load_model(args):
+def file_digest(path, block_size=1 << 20):
+    """SHA-256 of a file, memoized on its path, size and modification time."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _artifact_digests:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                sha.update(block)
+        _artifact_digests[key] = sha.hexdigest()
+    return _artifact_digests[key]
+
+
+def check_cache_dir():
+    """
+    Create `artifact_cache_dir` private to the current user, or check that an
+    existing one is. Extracted artifacts are unpickled by joblib, so no other
+    user may be able to plant or swap them.
+    """
+    os.makedirs(artifact_cache_dir, mode=0o700, exist_ok=True)
+    stat = os.stat(artifact_cache_dir)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+        raise ValueError(
+            f"Artifact cache {artifact_cache_dir} must be owned by the current"
+            " user and writable by no one else"
+        )
+
+
+def load_artifact(tar_path, member="model.joblib", mmap_mode=None):
+    """
+    Load a joblib object from a model tarball.
+
+    Each distinct tarball is extracted once into a directory named after its
+    digest under `artifact_cache_dir`, by default in the cache directory of
+    the user, and the loaded objects are memoized in-process with LRU
+    eviction. Pass `mmap_mode="r"` to memory-map the numpy arrays of the
+    object instead of reading them into memory.
+    """
+    digest = file_digest(tar_path)
+    key = (digest, member, mmap_mode)
+    if key in _artifact_cache:
+        _artifact_cache.move_to_end(key)
+        return _artifact_cache[key]
+
+    check_cache_dir()
+    extract_dir = os.path.join(artifact_cache_dir, digest)
+    if not os.path.exists(extract_dir):
+        tmp_dir = tempfile.mkdtemp(dir=artifact_cache_dir)
+        with tarfile.open(tar_path) as archive:
+            archive.extractall(path=tmp_dir)
+        try:
+            os.rename(tmp_dir, extract_dir)
+        except OSError:
+            # Extracted concurrently by another process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    artifact = joblib.load(os.path.join(extract_dir, member), mmap_mode=mmap_mode)
+
+    _artifact_cache[key] = artifact
+    while len(_artifact_cache) > artifact_cache_size:
+        _artifact_cache.popitem(last=False)
+    return artifact
+
+
+def load_model(args, mmap_mode=None):
     model_path = os.path.join(args.data_dir, args.model_input)
-    print(f"LOAD_MODEL: Extracting model from path: {model_path}")
-    print(f"LOAD_MODEL: Extracting model file to {os.getcwd()}")
-    with tarfile.open(model_path) as tar:
-        tar.extractall(path=".")
-    print("Loading model")
-    return joblib.load("model.joblib")
+    print(f"LOAD_MODEL: Loading model from path: {model_path}")
+    return load_artifact(model_path, mmap_mode=mmap_mode)
+
+
+def baseline_delta(report_dict, args):
+    """
+    Difference of the headline metrics from a baseline report, typically a
+    float64 run when evaluating features stored as float32.
+    """
+    with open(os.path.join(args.data_dir, args.baseline_eval)) as f:
+        baseline = json.load(f)
+    return {
+        "dtype": baseline.get("dtype", "float64"),
+        "accuracy": report_dict["accuracy"] - baseline["accuracy"],
+        "roc_auc": report_dict["roc_auc"] - baseline["roc_auc"],
+        "macro_f1": report_dict["macro avg"]["f1-score"]
+        - baseline["macro avg"]["f1-score"],
+    }
 
 
 def evaluate(model, X_test, y_test, args):
@@ -39,6 +278,9 @@ def evaluate(model, X_test, y_test, args):
     report_dict = classification_report(y_test, predictions, output_dict=True)
     report_dict["accuracy"] = accuracy_score(y_test, predictions)
     report_dict["roc_auc"] = roc_auc_score(y_test, predictions)
+    report_dict["dtype"] = args.dtype
+    if args.baseline_eval:
+        report_dict["baseline_delta"] = baseline_delta(report_dict, args)
     print(f"Classification report:\n{report_dict}")
     evaluation_output_path = os.path.join(args.data_dir, args.eval_output)
     print(f"Saving classification report to {evaluation_output_path}")
@@ -54,6 +296,13 @@ def parse_arg():
     parser.add_argument("--labels-input", type=str, default="test/test_labels.csv")
     parser.add_argument("--model-input", type=str, default="model/model.tar.gz")
     parser.add_argument("--eval-output", type=str, default="evaluation/evaluation.json")
+    parser.add_argument(
+        "--feature-format", type=str, default="csv", choices=list(feature_extensions)
+    )
+    parser.add_argument(
+        "--dtype", type=str, default="float64", choices=["float32", "float64"]
+    )
+    parser.add_argument("--baseline-eval", type=str, default=None)
     args, _ = parser.parse_known_args()
     print(f"Received arguments {args}")
     return args
@@ -9,6 +9,11 @@ import pandas as pd
 from loguru import logger
 from sklearn.model_selection import train_test_split
 
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
 columns = [
     "age",
     "education",
@@ -21,17 +26,83 @@ columns = [
     "income",
 ]
 
+column_dtypes = {
+    "age": "Int32",
+    "education": "category",
+    "major industry code": "category",
+    "class of worker": "category",
+    "num persons worked for employer": "Int32",
+    "capital gains": "Int32",
+    "capital losses": "Int32",
+    "dividends from stocks": "Int32",
+    "income": "category",
+}
+numeric_dtypes = {
+    col: "int32" for col, dtype in column_dtypes.items() if dtype == "Int32"
+}
+
 target_col = "income"
 class_labels = [" - 50000.", " 50000+."]
-
-
-def read_data(input_data_path):
+label_map = {label: i for i, label in enumerate(class_labels)}
+# The read_csv engines of the pinned pandas 1.3 that read in chunks; the
+# pyarrow engine needs pandas 1.4 and cannot read in chunks
+csv_engines = ["c", "python"]
+
+
+def read_data_polars(input_data_path: str) -> pd.DataFrame:
+    """Polars version of the reading and cleaning in `read_data`."""
+    # The NA strings of pd.read_csv, imported here as they are private
+    from pandas._libs.parsers import STR_NA_VALUES
+
+    # Only APIs that are the same from Polars 0.18 to 1.x are used: columns
+    # are read as strings and cast, and the labels are mapped by when/then
+    raw = (
+        pl.read_csv(
+            input_data_path,
+            columns=columns,
+            infer_schema_length=0,
+            null_values=list(STR_NA_VALUES),
+        )
+        .select(columns)
+        .with_columns([pl.col(col).cast(pl.Int32) for col in numeric_dtypes])
+    )
+    labels = pl.when(pl.col(target_col) == class_labels[0]).then(0)
+    for label in class_labels[1:]:
+        labels = labels.when(pl.col(target_col) == label).then(label_map[label])
+    df = (
+        raw.with_columns(pl.Series("index", np.arange(raw.height, dtype="int64")))
+        .lazy()
+        .drop_nulls(columns)
+        .unique(subset=columns, keep="first", maintain_order=True)
+        .with_columns(labels.otherwise(None).cast(pl.Int8).alias(target_col))
+        .collect()
+    )
+    result = df.select(columns).to_pandas()
+    result.index = df["index"].to_numpy().astype("int64")
+    # pandas categories are the sorted values of the whole column
+    categories = {
+        col: pd.CategoricalDtype(raw[col].drop_nulls().unique().sort().to_list())
+        for col, dtype in column_dtypes.items()
+        if dtype == "category" and col != target_col
+    }
+    return result.astype(categories)
+
+
+def read_data(input_data_path, engine="c", backend="pandas"):
     logger.info(f"Reading input data from {input_data_path}")
-    df = pd.read_csv(input_data_path)
-    df = pd.DataFrame(data=df, columns=columns)
-    df.dropna(inplace=True)
-    df.drop_duplicates(inplace=True)
-    df.replace(class_labels, list(range(len(class_labels))), inplace=True)
+    if backend == "polars":
+        if pl is None:
+            raise ImportError("--backend polars requires polars")
+        df = read_data_polars(input_data_path)
+    else:
+        df = pd.read_csv(
+            input_data_path, usecols=columns, dtype=column_dtypes, engine=engine
+        )
+        df = pd.DataFrame(data=df, columns=columns)
+        df.dropna(inplace=True)
+        df = df.astype(numeric_dtypes)
+        df.drop_duplicates(inplace=True)
+        df[target_col] = df[target_col].map(label_map).astype("int8")
     negative_examples, positive_examples = np.bincount(df[target_col])
     logger.info(
         f"Data after cleaning: {df.shape}, {positive_examples} positive examples, "
@@ -71,9 +142,14 @@ def write_json(data: dict, args, file_prefix) -> None:
         json.dump(data, f)
 
 
+def is_categorical(dtype) -> bool:
+    return dtype == "object" or dtype.name == "category"
+
+
 def get_cols_types(df: pd.DataFrame) -> Tuple[List[str], List[str]]:
-    cat_cols = df.columns[df.dtypes == "object"]
-    num_cols = df.columns[df.dtypes != "object"]
+    cat_mask = np.array([is_categorical(dtype) for dtype in df.dtypes], dtype=bool)
+    cat_cols = df.columns[cat_mask]
+    num_cols = df.columns[~cat_mask]
     assert (len(cat_cols) + len(num_cols)) == len(df.columns)
     return cat_cols, num_cols
 
@@ -107,7 +183,9 @@ def get_num_distribution(data: pd.Series) -> dict:
 
 
 def get_cat_counts(data: pd.Series) -> dict:
-    value_dict = data.value_counts().to_dict()
+    value_counts_series = data.value_counts()
+    # Categorical series also count categories that do not occur
+    value_dict = value_counts_series[value_counts_series > 0].to_dict()
     value_list = [{"name": name, "count": count} for name, count in value_dict.items()]
     count_dict = {"categorical": value_list}
     return count_dict
@@ -128,7 +206,7 @@ def generate_statistic(X_train: pd.DataFrame, y_train: pd.Series, args=None):
     stats_dict = get_dataframe_stats(X_train)
     for col, dtype in X_train.dtypes.to_dict().items():
         logger.debug(col, dtype)
-        if dtype == "object":
+        if is_categorical(dtype):
             dist = get_cat_counts(X_train[col])
         else:
             dist = get_num_distribution(X_train[col])
@@ -262,6 +340,10 @@ def parse_arg():
         default="profiling/baseline/train_features_baseline.csv",
     )
     parser.add_argument("--train_test_split_ratio", type=float, default=0.3)
+    parser.add_argument("--csv_engine", type=str, default="c", choices=csv_engines)
+    parser.add_argument(
+        "--backend", type=str, default="pandas", choices=["pandas", "polars"]
+    )
     args, _ = parser.parse_known_args()
     logger.info(f"Received arguments {args}")
     return args
@@ -285,7 +367,7 @@ def main(args):
         # TODO: if there data has been in proper format, there is no processing
         # required.
         infer_data_path = os.path.join(args.data_dir, args.train_input)
-        df = read_data(infer_data_path)
+        df = read_data(infer_data_path, args.csv_engine, args.backend)
         X_train, X_test, y_train, y_test = split_data(df, args)
 
         # Save baseline data for future reference
@@ -316,7 +398,7 @@ def main(args):
 
         # Read new inference features
         infer_data_path = os.path.join(args.data_dir, args.infer_input)
-        X_infer = read_data(infer_data_path)
+        X_infer = read_data(infer_data_path, args.csv_engine, args.backend)
         X_infer = X_infer.drop(["income"], axis=1)
 
         # Calculate PSI for inference vs baseline data
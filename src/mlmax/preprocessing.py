@@ -1,20 +1,46 @@
 import argparse
+import copy
+import glob
+import hashlib
+import io
+import json
 import os
+import shutil
 import tarfile
+import tempfile
 import warnings
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
+import sklearn
+from scipy import sparse
+from sklearn.base import BaseEstimator, TransformerMixin, clone
 from sklearn.compose import make_column_transformer
 from sklearn.exceptions import DataConversionWarning
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import KBinsDiscretizer, OneHotEncoder, StandardScaler
+from sklearn.utils import murmurhash3_32
 
 warnings.filterwarnings(action="ignore", category=DataConversionWarning)
 try:
     from sklearn.externals import joblib
 except:
     import joblib
+try:
+    import fsspec
+except ImportError:
+    fsspec = None
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 columns = [
     "age",
@@ -28,17 +54,342 @@ columns = [
     "income",
 ]
 
+column_dtypes = {
+    "age": "Int32",
+    "education": "category",
+    "major industry code": "category",
+    "class of worker": "category",
+    "num persons worked for employer": "Int32",
+    "capital gains": "Int32",
+    "capital losses": "Int32",
+    "dividends from stocks": "Int32",
+    "income": "category",
+}
+numeric_dtypes = {
+    col: "int32" for col, dtype in column_dtypes.items() if dtype == "Int32"
+}
+
+feature_extensions = {
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "feather": ".feather",
+    "npy": ".npy",
+    "npz": ".npz",
+}
+
+binned_cols = ["age", "num persons worked for employer"]
+scaled_cols = ["capital gains", "capital losses", "dividends from stocks"]
+categorical_cols = ["education", "major industry code", "class of worker"]
+n_bins = 10
+# KBinsDiscretizer.fit removes bins narrower than 1e-8 since scikit-learn 0.21
+drops_narrow_bins = tuple(map(int, sklearn.__version__.split(".")[:2])) >= (0, 21)
+n_hash_buckets = 10000
+n_hash_features = 1024
+
+compression_extensions = {"gzip": ".gz", "zstd": ".zst"}
+write_block_rows = 50000
+
 target_col = "income"
 class_labels = [" - 50000.", " 50000+."]
+label_map = {label: i for i, label in enumerate(class_labels)}
+# The read_csv engines of the pinned pandas 1.3 that read in chunks; the
+# pyarrow engine needs pandas 1.4 and cannot read in chunks
+csv_engines = ["c", "python"]
 
 
-def read_data(input_data_path):
-    print(f"Reading input data from {input_data_path}")
-    df = pd.read_csv(input_data_path)
+artifact_cache_dir = os.environ.get(
+    "MLMAX_ARTIFACT_CACHE",
+    os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "mlmax-artifacts",
+    ),
+)
+artifact_cache_size = 4
+_artifact_cache = OrderedDict()
+_artifact_digests = {}
+
+# Checked on the raw input before cleaning, see --data-quality-rules
+data_quality_rules = {
+    "rows": [1, None],
+    "max_null_ratio": {col: 0.5 for col in columns},
+    "ranges": {col: [0, None] for col in binned_cols + scaled_cols},
+    "categories": {target_col: class_labels},
+}
+
+# Output directories of each mode, and the arguments that change the outputs
+feature_cache_outputs = {"infer": ["test"], "train": ["train", "test", "model"]}
+feature_cache_args = [
+    "mode",
+    "train_test_split_ratio",
+    "chunksize",
+    "split_method",
+    "sparse",
+    "compiled",
+    "output_shards",
+    "dtype",
+    "hash_cols",
+    "hash_features",
+    "feature_format",
+    "compression",
+    "fit_sample",
+]
+
+
+def clean_data(df):
     df = pd.DataFrame(data=df, columns=columns)
     df.dropna(inplace=True)
+    # Numeric columns are read as nullable Int32, which nulls no longer need
+    df = df.astype(numeric_dtypes)
     df.drop_duplicates(inplace=True)
-    df.replace(class_labels, list(range(len(class_labels))), inplace=True)
+    df[target_col] = df[target_col].map(label_map).astype("int8")
+    return df
+
+
+def read_csv(input_data_path, engine="c", **kwargs):
+    """Read only the required columns, with compact dtypes."""
+    return pd.read_csv(
+        input_data_path, usecols=columns, dtype=column_dtypes, engine=engine, **kwargs
+    )
+
+
+def summarize_data(df):
+    """
+    Summarize a raw frame for the data quality gate, with vectorized column
+    reductions: row count, null counts, numeric extremes and categories.
+    """
+    numeric = df[binned_cols + scaled_cols]
+    return {
+        "rows": len(df),
+        "nulls": df.isna().sum().to_dict(),
+        "min": numeric.min().to_dict(),
+        "max": numeric.max().to_dict(),
+        "categories": {
+            col: set(df[col].dropna().unique())
+            for col in categorical_cols + [target_col]
+        },
+    }
+
+
+def summarize_data_polars(raw):
+    numeric = raw.select(binned_cols + scaled_cols)
+    return {
+        "rows": raw.height,
+        "nulls": dict(zip(raw.columns, raw.null_count().row(0))),
+        "min": dict(zip(numeric.columns, numeric.min().row(0))),
+        "max": dict(zip(numeric.columns, numeric.max().row(0))),
+        "categories": {
+            col: set(raw[col].drop_nulls().unique().to_list())
+            for col in categorical_cols + [target_col]
+        },
+    }
+
+
+def merge_summaries(summary, other):
+    if summary is None:
+        return other
+
+    def extreme(reduce, a, b):
+        values = [value for value in (a, b) if pd.notna(value)]
+        return reduce(values) if values else np.nan
+
+    return {
+        "rows": summary["rows"] + other["rows"],
+        "nulls": {col: n + other["nulls"][col] for col, n in summary["nulls"].items()},
+        "min": {
+            col: extreme(min, v, other["min"][col]) for col, v in summary["min"].items()
+        },
+        "max": {
+            col: extreme(max, v, other["max"][col]) for col, v in summary["max"].items()
+        },
+        "categories": {
+            col: values | other["categories"][col]
+            for col, values in summary["categories"].items()
+        },
+    }
+
+
+def check_data_quality(summary, rules, final=True):
+    """
+    Check a data summary against the rules and raise a ValueError listing
+    every violation. Row counts and null ratios only apply to the whole
+    input, so they are checked when `final` only.
+    """
+    problems = []
+    for col, (low, high) in rules.get("ranges", {}).items():
+        lowest, highest = summary["min"].get(col), summary["max"].get(col)
+        if (low is not None and pd.notna(lowest) and lowest < low) or (
+            high is not None and pd.notna(highest) and highest > high
+        ):
+            problems.append(
+                f"{col}: values in [{lowest}, {highest}], expected [{low}, {high}]"
+            )
+    for col, allowed in rules.get("categories", {}).items():
+        unexpected = sorted(summary["categories"].get(col, set()) - set(allowed))
+        if unexpected:
+            problems.append(
+                f"{col}: {len(unexpected)} unexpected categories, e.g. {unexpected[:3]}"
+            )
+    if final:
+        n_rows = summary["rows"]
+        low, high = rules.get("rows", [None, None])
+        if (low is not None and n_rows < low) or (high is not None and n_rows > high):
+            problems.append(f"rows: {n_rows}, expected [{low}, {high}]")
+        for col, max_ratio in rules.get("max_null_ratio", {}).items():
+            ratio = summary["nulls"].get(col, 0) / max(n_rows, 1)
+            if ratio > max_ratio:
+                problems.append(
+                    f"{col}: null ratio {ratio:.3f}, expected at most {max_ratio}"
+                )
+    if problems:
+        raise ValueError(
+            f"Data quality check failed with {len(problems)} problems:\n  "
+            + "\n  ".join(problems)
+        )
+    return summary
+
+
+def load_data_quality_rules(args):
+    """
+    The default rules, updated per rule with those of the JSON file given
+    with --data-quality-rules.
+    """
+    rules = copy.deepcopy(data_quality_rules)
+    if args.data_quality_rules:
+        rules_path = os.path.join(args.data_dir, args.data_quality_rules)
+        print(f"Reading data quality rules from {rules_path}")
+        with open(rules_path) as f:
+            for key, value in json.load(f).items():
+                if isinstance(value, dict):
+                    rules.setdefault(key, {}).update(value)
+                else:
+                    rules[key] = value
+    return rules
+
+
+def byte_ranges(path, n_parts):
+    """
+    Split a CSV file into at most `n_parts` byte ranges of whole lines,
+    excluding the header line. Fields must not contain quoted newlines.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header = f.readline()
+        boundaries = [len(header)]
+        for i in range(1, n_parts):
+            f.seek(max(size * i // n_parts, boundaries[-1]))
+            f.readline()
+            boundaries.append(min(f.tell(), size))
+    boundaries.append(size)
+    ranges = zip(boundaries[:-1], boundaries[1:])
+    return header, [(start, end) for start, end in ranges if end > start]
+
+
+def read_byte_range(task):
+    path, header, start, end, engine = task
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    raw = read_csv(io.BytesIO(header + data), engine=engine)
+    return summarize_data(raw), clean_data(raw)
+
+
+def read_data_parallel(paths, n_jobs, engine="c", rules=None):
+    """
+    Read and clean CSV files in parallel, splitting each file into `n_jobs`
+    byte ranges that are parsed in a process pool. With `rules`, the
+    summaries of the raw parts are checked before they are pooled.
+    """
+    tasks = []
+    for path in paths:
+        header, ranges = byte_ranges(path, n_jobs)
+        tasks.extend((path, header, start, end, engine) for start, end in ranges)
+    print(f"Reading {len(paths)} files in {len(tasks)} parts with {n_jobs} processes")
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            parts = list(executor.map(read_byte_range, tasks))
+    else:
+        parts = [read_byte_range(task) for task in tasks]
+    if rules is not None:
+        summary = None
+        for part_summary, _ in parts:
+            summary = merge_summaries(summary, part_summary)
+        check_data_quality(summary, rules)
+    df = pd.concat([part for _, part in parts], ignore_index=True)
+    # Parts may have different categories, which concat turns into object
+    categories = {col: "category" for col in categorical_cols}
+    df = df.drop_duplicates().astype(categories)
+    return df.reset_index(drop=True)
+
+
+def read_data_polars(paths, pooled=False, rules=None):
+    """
+    Read and clean CSV files with Polars, which parses and deduplicates on
+    all cores. The frame is the same as the pandas readers return: a single
+    file keeps the positions of its rows as index and the categories of the
+    whole column, and pooled reads match `read_data_parallel`.
+    """
+    # The NA strings of pd.read_csv, imported here as they are private
+    from pandas._libs.parsers import STR_NA_VALUES
+
+    # Only APIs that are the same from Polars 0.18 to 1.x are used: columns
+    # are read as strings and cast, and the labels are mapped by when/then
+    raw = pl.concat(
+        [
+            pl.read_csv(
+                path,
+                columns=columns,
+                infer_schema_length=0,
+                null_values=list(STR_NA_VALUES),
+            ).select(columns)
+            for path in paths
+        ]
+    ).with_columns([pl.col(col).cast(pl.Int32) for col in numeric_dtypes])
+    if rules is not None:
+        check_data_quality(summarize_data_polars(raw), rules)
+    labels = pl.when(pl.col(target_col) == class_labels[0]).then(0)
+    for label in class_labels[1:]:
+        labels = labels.when(pl.col(target_col) == label).then(label_map[label])
+    df = (
+        raw.with_columns(pl.Series("index", np.arange(raw.height, dtype="int64")))
+        .lazy()
+        .drop_nulls(columns)
+        .unique(subset=columns, keep="first", maintain_order=True)
+        .with_columns(labels.otherwise(None).cast(pl.Int8).alias(target_col))
+        .collect()
+    )
+    result = df.select(columns).to_pandas()
+    if pooled:
+        return result.astype({col: "category" for col in categorical_cols})
+    result.index = df["index"].to_numpy().astype("int64")
+    categories = {
+        col: pd.CategoricalDtype(raw[col].drop_nulls().unique().sort().to_list())
+        for col in categorical_cols
+    }
+    return result.astype(categories)
+
+
+def read_data(input_data_path, engine="c", n_jobs=1, backend="pandas", rules=None):
+    """
+    Read and clean the input CSV. `input_data_path` may be a glob pattern
+    matching several files, which are read in parallel like large files.
+    With `backend="polars"` the files are read and cleaned by Polars.
+
+    With `rules`, the raw input goes through the data quality gate before it
+    is cleaned, see `check_data_quality`.
+    """
+    print(f"Reading input data from {input_data_path}")
+    paths = sorted(glob.glob(input_data_path)) or [input_data_path]
+    if backend == "polars":
+        if pl is None:
+            raise ImportError("--backend polars requires polars")
+        df = read_data_polars(paths, n_jobs > 1 or len(paths) > 1, rules)
+    elif n_jobs > 1 or len(paths) > 1:
+        df = read_data_parallel(paths, n_jobs, engine, rules)
+    else:
+        raw = read_csv(input_data_path, engine=engine)
+        if rules is not None:
+            check_data_quality(summarize_data(raw), rules)
+        df = clean_data(raw)
     negative_examples, positive_examples = np.bincount(df[target_col])
     print(
         f"Data after cleaning: {df.shape}, {positive_examples} positive examples, "
@@ -47,30 +398,545 @@ def read_data(input_data_path):
     return df
 
 
+def row_hashes(df):
+    """Deterministic 64-bit hash of each row, independent of the index."""
+    return pd.util.hash_pandas_object(df, index=False).values
+
+
+def drop_seen(df, seen):
+    """
+    Drop rows whose hash is in the sorted `uint64` array `seen`, and return
+    the remaining rows with `seen` updated with their hashes. Rows within
+    `df` are expected to be distinct already.
+    """
+    hashes = row_hashes(df)
+    positions = np.searchsorted(seen, hashes)
+    is_seen = np.zeros(len(hashes), dtype=bool)
+    found = positions < len(seen)
+    is_seen[found] = seen[positions[found]] == hashes[found]
+    new = np.unique(hashes[~is_seen])
+    return df[~is_seen], np.insert(seen, np.searchsorted(seen, new), new)
+
+
+def read_data_chunks(input_data_path, chunksize, engine="c", rules=None):
+    """
+    Yield cleaned chunks of at most `chunksize` raw rows.
+
+    Duplicates are dropped across chunks by their 64-bit row hash, so only one
+    hash per distinct row, 8 bytes in a sorted array, is kept in memory.
+
+    With `rules`, each raw chunk is checked before it is yielded, and the
+    row count and null ratios of the whole input after the last chunk.
+    """
+    print(f"Reading input data from {input_data_path} in chunks of {chunksize}")
+    seen = np.empty(0, dtype="uint64")
+    summary = None
+    for chunk in read_csv(input_data_path, engine=engine, chunksize=chunksize):
+        if rules is not None:
+            summary = merge_summaries(summary, summarize_data(chunk))
+            check_data_quality(summary, rules, final=False)
+        df, seen = drop_seen(clean_data(chunk), seen)
+        yield df
+    if summary is not None:
+        check_data_quality(summary, rules)
+
+
+def file_digest(path, block_size=1 << 20):
+    """SHA-256 of a file, memoized on its path, size and modification time."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _artifact_digests:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                sha.update(block)
+        _artifact_digests[key] = sha.hexdigest()
+    return _artifact_digests[key]
+
+
+def check_cache_dir():
+    """
+    Create `artifact_cache_dir` private to the current user, or check that an
+    existing one is. Extracted artifacts are unpickled by joblib, so no other
+    user may be able to plant or swap them.
+    """
+    os.makedirs(artifact_cache_dir, mode=0o700, exist_ok=True)
+    stat = os.stat(artifact_cache_dir)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+        raise ValueError(
+            f"Artifact cache {artifact_cache_dir} must be owned by the current"
+            " user and writable by no one else"
+        )
+
+
+def load_artifact(tar_path, member="model.joblib", mmap_mode=None):
+    """
+    Load a joblib object from a model tarball.
+
+    Each distinct tarball is extracted once into a directory named after its
+    digest under `artifact_cache_dir`, by default in the cache directory of
+    the user, and the loaded objects are memoized in-process with LRU
+    eviction. Pass `mmap_mode="r"` to memory-map the numpy arrays of the
+    object instead of reading them into memory.
+    """
+    digest = file_digest(tar_path)
+    key = (digest, member, mmap_mode)
+    if key in _artifact_cache:
+        _artifact_cache.move_to_end(key)
+        return _artifact_cache[key]
+
+    check_cache_dir()
+    extract_dir = os.path.join(artifact_cache_dir, digest)
+    if not os.path.exists(extract_dir):
+        tmp_dir = tempfile.mkdtemp(dir=artifact_cache_dir)
+        with tarfile.open(tar_path) as archive:
+            archive.extractall(path=tmp_dir)
+        try:
+            os.rename(tmp_dir, extract_dir)
+        except OSError:
+            # Extracted concurrently by another process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    artifact = joblib.load(os.path.join(extract_dir, member), mmap_mode=mmap_mode)
+
+    _artifact_cache[key] = artifact
+    while len(_artifact_cache) > artifact_cache_size:
+        _artifact_cache.popitem(last=False)
+    return artifact
+
+
+def load_preprocess(args):
+    if args.compiled:
+        return load_compiled(args)
+    model_path = os.path.join(args.data_dir, "model/proc_model.tar.gz")
+    print(f"Reading model from {model_path}")
+    return load_artifact(model_path)
+
+
+def hash_indices(values, col, n_features):
+    """
+    Hash each value of column `col` to one of `n_features` output columns.
+    Every distinct value is hashed once, with its column name as a prefix so
+    that equal values of different columns do not share a column.
+    """
+    codes, uniques = pd.factorize(np.asarray(values, dtype=str))
+    hashes = [murmurhash3_32(f"{col}={value}", positive=True) for value in uniques]
+    return (np.asarray(hashes, dtype=np.int64) % n_features)[codes]
+
+
+class HashingEncoder(BaseEstimator, TransformerMixin):
+    """
+    Encode categorical columns as counts over a fixed number of hashed
+    columns. Nothing is learned in `fit`, so the model holds no vocabulary,
+    unseen categories need no special handling and the output width does
+    not grow with the cardinality of the input.
+    """
+
+    def __init__(self, n_features=n_hash_features, sparse=True):
+        self.n_features = n_features
+        self.sparse = sparse
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X):
+        X = pd.DataFrame(X)
+        n_rows = len(X)
+        indices = [hash_indices(X[col], col, self.n_features) for col in X.columns]
+        features = sparse.csr_matrix(
+            (
+                np.ones(n_rows * len(indices)),
+                (np.tile(np.arange(n_rows), len(indices)), np.concatenate(indices)),
+            ),
+            shape=(n_rows, self.n_features),
+        )
+        return features if self.sparse else features.toarray()
+
+
+def compile_preprocess(preprocess):
+    """
+    Export a fitted preprocessing model as plain numpy arrays: inner bin edges
+    per binned column, scaler offsets and scales, the sorted categories of
+    each one-hot column and the width of the hashed columns.
+    """
+    compiled = {}
+    for _, transformer, cols in preprocess.transformers_:
+        if isinstance(transformer, KBinsDiscretizer):
+            compiled["binned_cols"] = np.array(cols, dtype=str)
+            for i, edges in enumerate(transformer.bin_edges_):
+                compiled[f"bin_edges_{i}"] = np.asarray(edges[1:-1], dtype=float)
+        elif isinstance(transformer, StandardScaler):
+            compiled["scaled_cols"] = np.array(cols, dtype=str)
+            compiled["mean"] = transformer.mean_
+            compiled["scale"] = transformer.scale_
+        elif isinstance(transformer, OneHotEncoder):
+            compiled["categorical_cols"] = np.array(cols, dtype=str)
+            for i, categories in enumerate(transformer.categories_):
+                compiled[f"categories_{i}"] = np.asarray(categories, dtype=str)
+        elif isinstance(transformer, HashingEncoder):
+            compiled["hashed_cols"] = np.array(cols, dtype=str)
+            compiled["n_hash_features"] = np.array(transformer.n_features)
+    return compiled
+
+
+def export_compiled(preprocess, args):
+    compiled = compile_preprocess(preprocess)
+    output_path = os.path.join(args.data_dir, "model/proc_compiled.npz")
+    print(f"Saving compiled model to {output_path}")
+    np.savez(output_path, **compiled)
+    return compiled
+
+
+def load_compiled(args):
+    model_path = os.path.join(args.data_dir, "model/proc_compiled.npz")
+    print(f"Reading compiled model from {model_path}")
+    with np.load(model_path) as npz:
+        return dict(npz)
+
+
+def transform_compiled(compiled, df):
+    """
+    Apply a compiled preprocessing model to a frame, or to a dict of column
+    arrays. The output matches the dense output of the sklearn model.
+    """
+    binned = []
+    for i, col in enumerate(compiled["binned_cols"]):
+        x = np.asarray(df[col], dtype=float)
+        # Same tolerance as KBinsDiscretizer.transform
+        eps = 1.0e-8 + 1.0e-5 * np.abs(x)
+        edges = compiled[f"bin_edges_{i}"]
+        binned.append((np.searchsorted(edges, x + eps, side="right"), len(edges) + 1))
+
+    scaled = np.column_stack([df[col] for col in compiled["scaled_cols"]])
+    scaled = (scaled - compiled["mean"]) / compiled["scale"]
+
+    onehot = []
+    for i, col in enumerate(compiled.get("categorical_cols", [])):
+        x = np.asarray(df[col], dtype=str)
+        categories = compiled[f"categories_{i}"]
+        index = np.searchsorted(categories, x).clip(max=len(categories) - 1)
+        unknown = categories[index] != x
+        if unknown.any():
+            raise ValueError(
+                f"Found unknown categories {sorted(set(x[unknown]))} in column {col}"
+            )
+        onehot.append((index, len(categories)))
+
+    hashed_cols = compiled.get("hashed_cols", [])
+    n_hashed = int(compiled["n_hash_features"]) if len(hashed_cols) else 0
+    hashed = [hash_indices(df[col], col, n_hashed) for col in hashed_cols]
+
+    n_rows, n_scaled = scaled.shape
+    width = sum(w for _, w in binned) + n_scaled + sum(w for _, w in onehot)
+    width += n_hashed
+    features = np.zeros((n_rows, width))
+    rows = np.arange(n_rows)
+    offset = 0
+    for index, w in binned:
+        features[rows, offset + index] = 1.0
+        offset += w
+    features[:, offset : offset + n_scaled] = scaled
+    offset += n_scaled
+    for index, w in onehot:
+        features[rows, offset + index] = 1.0
+        offset += w
+    for index in hashed:
+        # Values of different columns may collide, so hashed columns are counts
+        np.add.at(features, (rows, offset + index), 1.0)
+    return features
+
+
 def transform(df, args, preprocess=None):
     if preprocess is None:
-        model_directory = os.path.join(args.data_dir, "model")
-        print(f"Reading model from {model_directory}")
-        with tarfile.open(
-            os.path.join(model_directory, "proc_model.tar.gz"), mode="r:gz"
-        ) as archive:
-            print(f"Exctracting tarfile to {model_directory}")
-            archive.extractall(path=model_directory)
-        preprocess = joblib.load(os.path.join(model_directory, "model.joblib"))
-    features = preprocess.transform(df)
+        preprocess = load_preprocess(args)
+    if args.compiled:
+        features = transform_compiled(preprocess, df)
+    else:
+        features = preprocess.transform(df)
+    features = features.astype(args.dtype, copy=False)
     print(f"Data shape after preprocessing: {features.shape}")
     return features
 
 
-def write_data(data, args, file_prefix):
-    output_path = os.path.join(args.data_dir, file_prefix)
+def transform_chunks(input_data_path, args):
+    """
+    Clean, transform and write the input chunk by chunk, so that peak memory
+    is bounded by `args.chunksize` rather than by the size of the input.
+
+    The row count and null ratios of the input are only known after the
+    last chunk, so the outputs are staged in a hidden directory of the test
+    output directory, and only moved into place once the whole input passed
+    the data quality checks.
+    """
+    if args.feature_format != "csv":
+        raise ValueError("--chunksize is only supported with --feature-format csv")
+    preprocess = load_preprocess(args)
+    n_rows = 0
+    shard_rows = None
+    has_labels = False
+    rules = load_data_quality_rules(args)
+    output_dir = os.path.join(args.data_dir, "test")
+    staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=output_dir)
+    staged_args = argparse.Namespace(**vars(args))
+    staged_args.data_dir = staging_dir
+    os.makedirs(os.path.join(staging_dir, "test"))
+    try:
+        chunks = read_data_chunks(
+            input_data_path, args.chunksize, args.csv_engine, rules
+        )
+        for df in chunks:
+            if df.empty:
+                # Every row of the chunk was dropped by cleaning
+                continue
+            mode = "a" if n_rows else "w"
+            features = transform(df, args, preprocess)
+            labels = df[target_col] if target_col in df.columns else None
+            has_labels = labels is not None
+            shard_rows = write_split(
+                features, labels, staged_args, "test", mode, shard_rows
+            )
+            n_rows += features.shape[0]
+        write_manifest(staged_args, "test", shard_rows, has_labels)
+        remove_outputs(args, "test")
+        for name in os.listdir(os.path.join(staging_dir, "test")):
+            os.replace(
+                os.path.join(staging_dir, "test", name), os.path.join(output_dir, name)
+            )
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    print(f"Transformed {n_rows} rows")
+    return n_rows
+
+
+def with_format(path, feature_format):
+    return os.path.splitext(path)[0] + feature_extensions[feature_format]
+
+
+def output_path_of(args, file_prefix):
+    path = with_format(os.path.join(args.data_dir, file_prefix), args.feature_format)
+    return path + compression_extensions.get(args.compression, "")
+
+
+def csv_blocks(data):
+    """
+    The CSV text of the rows of an array, in blocks of `write_block_rows`.
+    Each block is a zero-copy frame over the array, formatted by the pandas
+    C writer, which is faster than formatting the numbers with numpy.
+    """
+    for start in range(0, data.shape[0], write_block_rows):
+        block = pd.DataFrame(data[start : start + write_block_rows])
+        yield block.to_csv(header=False, index=False).encode()
+
+
+def compress_block(block, compression):
+    """
+    Compress a block into a complete gzip member or zstd frame. Members and
+    frames can be concatenated, so blocks are compressed independently.
+    """
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compress(block)
+    # wbits=31 writes a gzip header, with no timestamp for stable checksums
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+def compressed_blocks(blocks, compression, executor, window):
+    """
+    Compress blocks on `executor`, keeping at most `window` blocks in flight
+    while the next ones are formatted. zlib and zstd release the GIL.
+    """
+    pending = deque()
+    for block in blocks:
+        pending.append(executor.submit(compress_block, block, compression))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def write_csv(data, output_path, args, mode="w", executor=None):
+    data = np.asarray(data)
+    blocks = csv_blocks(data.reshape(data.shape[0], -1))
+    if args.compression:
+        blocks = compressed_blocks(
+            blocks, args.compression, executor, 2 * args.write_jobs
+        )
+    with open(output_path, mode + "b") as f:
+        for block in blocks:
+            f.write(block)
+
+
+def write_outputs(outputs, args, mode="w"):
+    """
+    Write `(data, file_prefix)` outputs concurrently on --write-jobs threads,
+    so that the formatting of one output overlaps with the compression and
+    writing of the others. An output may override `mode` as a third item.
+    """
+    if args.compression == "zstd" and zstandard is None:
+        raise ImportError("--compression zstd requires zstandard")
+    with ThreadPoolExecutor(args.write_jobs) as compressor, ThreadPoolExecutor(
+        args.write_jobs
+    ) as writer:
+        futures = []
+        for data, file_prefix, *output_mode in outputs:
+            futures.append(
+                writer.submit(
+                    write_data,
+                    data,
+                    args,
+                    file_prefix,
+                    output_mode[0] if output_mode else mode,
+                    compressor,
+                )
+            )
+        for future in futures:
+            future.result()
+
+
+def write_data(data, args, file_prefix, mode="w", executor=None):
+    """
+    Write an array or frame, without header or index. CSV outputs are
+    compressed with --compression, in blocks on `executor`.
+    """
+    feature_format = args.feature_format
+    if args.compression and feature_format != "csv":
+        raise ValueError("--compression is only supported with --feature-format csv")
+    output_path = output_path_of(args, file_prefix)
     print(f"Saving data to {output_path}")
-    pd.DataFrame(data).to_csv(output_path, header=False, index=False)
+    if feature_format == "npz":
+        if not sparse.issparse(data):
+            data = np.asarray(data).reshape(data.shape[0], -1)
+        sparse.save_npz(output_path, sparse.csr_matrix(data))
+        return
+    if sparse.issparse(data):
+        data = data.toarray()
+    if feature_format == "csv":
+        write_csv(data, output_path, args, mode, executor)
+    elif feature_format == "npy":
+        np.save(output_path, np.asarray(data))
+    else:
+        df = pd.DataFrame(np.asarray(data))
+        df.columns = df.columns.astype(str)
+        getattr(df, f"to_{feature_format}")(output_path)
+
+
+def hash_split(df, split_ratio):
+    """
+    Route each row to the test set if its hash falls in the first
+    `split_ratio` of `n_hash_buckets` buckets. The split is reproducible and
+    needs no shuffle, so chunks can be split independently.
+    """
+    is_test = row_hashes(df) % n_hash_buckets < split_ratio * n_hash_buckets
+    train, test = df[~is_test], df[is_test]
+    return (
+        train.drop(target_col, axis=1),
+        test.drop(target_col, axis=1),
+        train[target_col],
+        test[target_col],
+    )
+
+
+def shard_file_prefix(split, shard):
+    return f"{split}/part-{shard:05d}.csv"
+
+
+def write_split(features, labels, args, split, mode="w", shard_rows=None):
+    outputs, shard_rows = split_outputs(features, labels, args, split, shard_rows)
+    write_outputs(outputs, args, mode)
+    return shard_rows
+
+
+def split_outputs(features, labels, args, split, shard_rows=None):
+    """
+    The outputs of a split: `{split}_features` and `{split}_labels`, or with
+    `--output-shards N` N `part-*` files that hold the label in the first
+    column followed by the features. Each shard is then self-contained, for
+    ShardedByS3Key channels.
+
+    Rows are spread so that shards stay balanced across appended chunks.
+    Returns `(data, file_prefix)` pairs for `write_outputs`, and the number
+    of rows in each shard so far.
+    """
+    n_shards = args.output_shards
+    if n_shards <= 1:
+        outputs = [(features, f"{split}/{split}_features.csv")]
+        if labels is not None:
+            outputs.append((labels, f"{split}/{split}_labels.csv"))
+        return outputs, shard_rows
+
+    data = features
+    if labels is not None:
+        labels = np.asarray(labels, dtype=features.dtype).reshape(-1, 1)
+        if sparse.issparse(features):
+            data = sparse.hstack([labels, features], format="csr")
+        else:
+            data = np.hstack([labels, features])
+    if shard_rows is None:
+        shard_rows = np.zeros(n_shards, dtype=int)
+    n_rows = data.shape[0]
+    sizes = np.full(n_shards, n_rows // n_shards)
+    # The remainder goes to the currently smallest shards
+    sizes[np.argsort(shard_rows, kind="stable")[: n_rows % n_shards]] += 1
+    bounds = np.concatenate([[0], np.cumsum(sizes)])
+    outputs = [
+        (data[bounds[shard] : bounds[shard + 1]], shard_file_prefix(split, shard))
+        for shard in range(n_shards)
+    ]
+    return outputs, shard_rows + sizes
+
+
+def write_manifest(args, split, shard_rows, labels=True):
+    """
+    Record the row count and SHA-256 checksum of each shard of a split, and
+    whether the shards hold labels in their first column.
+    """
+    if shard_rows is None:
+        return
+    shards = []
+    for shard, rows in enumerate(shard_rows):
+        path = output_path_of(args, shard_file_prefix(split, shard))
+        shards.append(
+            {
+                "file": os.path.basename(path),
+                "rows": int(rows),
+                "sha256": file_digest(path),
+            }
+        )
+    manifest = {
+        "feature_format": args.feature_format,
+        "compression": args.compression,
+        "labels": labels,
+        "shards": shards,
+    }
+    output_path = os.path.join(args.data_dir, split, f"{split}_manifest.json")
+    print(f"Saving shard manifest to {output_path}")
+    with open(output_path, "w") as f:
+        json.dump(manifest, f)
+
+
+def remove_outputs(args, split):
+    """
+    Remove the outputs of an earlier run from the directory of a split,
+    single files and shards alike, so that readers never mix them with the
+    outputs of this run.
+    """
+    split_dir = os.path.join(args.data_dir, split)
+    patterns = [f"{split}_features.*", f"{split}_labels.*", f"{split}_manifest.json"]
+    for pattern in patterns + ["part-*"]:
+        for path in glob.glob(os.path.join(split_dir, pattern)):
+            os.remove(path)
 
 
 def split_data(df, args):
     split_ratio = args.train_test_split_ratio
     print(f"Splitting data into train and test sets with ratio {split_ratio}")
+    if args.split_method == "hash":
+        return hash_split(df, split_ratio)
+    n_rows = len(df)
+    if n_rows - np.ceil(split_ratio * n_rows) < 1:
+        # Too few rows to leave one for training, as in the last chunk of an
+        # input, so they all go to the training set
+        X, y = df.drop(target_col, axis=1), df[target_col]
+        return X, X.iloc[:0], y, y.iloc[:0]
     return train_test_split(
         df.drop(target_col, axis=1),
         df[target_col],
@@ -79,37 +945,508 @@ def split_data(df, args):
     )
 
 
-def fit(df, args):
-    preprocess = make_column_transformer(
-        (
-            ["age", "num persons worked for employer"],
-            KBinsDiscretizer(encode="onehot-dense", n_bins=10),
-        ),
-        (
-            ["capital gains", "capital losses", "dividends from stocks"],
-            StandardScaler(),
-        ),
+def onehot_cols(args):
+    return [col for col in categorical_cols if col not in args.hash_cols]
+
+
+def build_preprocess(args):
+    # In sparse mode the one-hot blocks stay CSR and the output is always CSR
+    transformers = [
         (
-            ["education", "major industry code", "class of worker"],
-            OneHotEncoder(sparse=False),
+            binned_cols,
+            KBinsDiscretizer(
+                encode="onehot" if args.sparse else "onehot-dense", n_bins=n_bins
+            ),
         ),
+        (scaled_cols, StandardScaler()),
+    ]
+    if onehot_cols(args):
+        transformers.append((onehot_cols(args), OneHotEncoder(sparse=args.sparse)))
+    if args.hash_cols:
+        transformers.append(
+            (
+                [col for col in categorical_cols if col in args.hash_cols],
+                HashingEncoder(args.hash_features, sparse=args.sparse),
+            )
+        )
+    return make_column_transformer(
+        *transformers, sparse_threshold=1.0 if args.sparse else 0.3
     )
-    print("Creating preprocessing and feature engineering transformations")
-    preprocess.fit(df)
+
+
+def save_preprocess(preprocess, args, stats=None):
+    """
+    Archive the fitted model, and the statistics it was fitted from so that a
+    later run can refit it incrementally with --refit-from.
+    """
     joblib.dump(preprocess, "./model.joblib")
     model_output_directory = os.path.join(args.data_dir, "model/proc_model.tar.gz")
     print(f"Saving model to {model_output_directory}")
     with tarfile.open(model_output_directory, mode="w:gz") as archive:
         archive.add("./model.joblib", recursive=True)
+        if stats is not None:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                stats_path = os.path.join(tmp_dir, "fit_stats.joblib")
+                joblib.dump(stats, stats_path)
+                archive.add(stats_path, arcname="./fit_stats.joblib")
+
+
+def fit(df, args):
+    """
+    Fit the preprocessing model on `df`. With --refit-from, the statistics
+    of `df` are merged into those of a previous model instead, so the cost
+    is proportional to the new data only. With --fit-sample, the scaler and
+    bin edges are fitted on a sample of `df`, see `fit_sample_stats`.
+    """
+    print("Creating preprocessing and feature engineering transformations")
+    if args.fit_sample:
+        sample = update_sample(init_sample(), df, args.fit_sample)
+        stats = fit_sample_stats(update_coverage(initial_fit_stats(args), df), sample)
+        write_sample_report(sample, args)
+    else:
+        stats = update_fit_stats(initial_fit_stats(args), df)
+    if args.refit_from or args.fit_sample:
+        preprocess = fit_from_stats(stats, args)
+    else:
+        preprocess = build_preprocess(args)
+        preprocess.fit(df)
+    save_preprocess(preprocess, args, stats)
+    return preprocess
+
+
+def update_sketch(sketch, values, max_size=10000):
+    """
+    Merge `values` into a quantile sketch of sorted value counts.
+
+    The sketch is exact while it holds at most `max_size` distinct values.
+    Beyond that, neighbouring values are merged into `max_size` buckets of
+    roughly equal weight, each represented by its weighted mean.
+    """
+    counts = pd.Series(values).value_counts()
+    if sketch is not None:
+        counts = sketch.add(counts, fill_value=0)
+    counts = counts.sort_index()
+    if len(counts) > max_size:
+        cum = counts.values.cumsum()
+        bucket = (cum - 1) * max_size // cum[-1]
+        weights = counts.groupby(bucket).sum()
+        sums = pd.Series(counts.index.values * counts.values).groupby(bucket).sum()
+        counts = pd.Series(weights.values, index=sums.values / weights.values)
+    return counts
+
+
+def sketch_quantiles(sketch, quantiles):
+    """Linearly interpolated quantiles, as np.percentile on the full column."""
+    values = sketch.index.values.astype(float)
+    cum = sketch.values.cumsum()
+    position = np.asarray(quantiles) * (cum[-1] - 1)
+    lower, upper = np.floor(position), np.ceil(position)
+    lower_value = values[np.searchsorted(cum, lower, side="right")]
+    upper_value = values[np.searchsorted(cum, upper, side="right")]
+    return lower_value + (upper_value - lower_value) * (position - lower)
+
+
+def init_fit_stats(cols=categorical_cols):
+    """Statistics to stream, collecting the categories of the `cols` only."""
+    return {
+        "scaler": StandardScaler(),
+        "sketches": {col: None for col in binned_cols},
+        "minmax": {col: (np.inf, -np.inf) for col in binned_cols},
+        "categories": {col: set() for col in cols},
+    }
+
+
+def stats_from_preprocess(preprocess):
+    """
+    Approximate the statistics of a model archived without them: the scaler
+    moments are exact, the bin edges stand in for the quantile sketches and
+    the one-hot categories for the category sets.
+    """
+    stats = init_fit_stats([])
+    n_samples = None
+    for _, transformer, _ in preprocess.transformers_:
+        if isinstance(transformer, StandardScaler):
+            stats["scaler"] = copy.deepcopy(transformer)
+            n_samples = np.max(transformer.n_samples_seen_)
+    for _, transformer, cols in preprocess.transformers_:
+        if isinstance(transformer, KBinsDiscretizer):
+            for col, edges in zip(cols, transformer.bin_edges_):
+                weight = (n_samples or len(edges)) / len(edges)
+                stats["sketches"][col] = pd.Series(weight, index=edges)
+                stats["minmax"][col] = (edges[0], edges[-1])
+        elif isinstance(transformer, OneHotEncoder):
+            for col, categories in zip(cols, transformer.categories_):
+                stats["categories"][col] = set(categories)
+    return stats
+
+
+def load_fit_stats(tar_path):
+    try:
+        stats = load_artifact(tar_path, "fit_stats.joblib")
+    except FileNotFoundError:
+        print(f"No statistics in {tar_path}, approximating them from the model")
+        return stats_from_preprocess(load_artifact(tar_path))
+    # The loaded statistics are memoized, so update a copy
+    return copy.deepcopy(stats)
+
+
+def initial_fit_stats(args):
+    """
+    Statistics to start a fit from: empty ones, or with --refit-from those of
+    the previous model.
+    """
+    cols = onehot_cols(args)
+    if not args.refit_from:
+        return init_fit_stats(cols)
+    model_path = os.path.join(args.data_dir, args.refit_from)
+    print(f"Refitting from {model_path}")
+    stats = load_fit_stats(model_path)
+    stats["categories"] = {col: stats["categories"].get(col, set()) for col in cols}
+    return stats
+
+
+def update_fit_stats(stats, df):
+    """Accumulate the sufficient statistics of the preprocessing model."""
+    stats["scaler"].partial_fit(df[scaled_cols])
+    for col in binned_cols:
+        stats["sketches"][col] = update_sketch(stats["sketches"][col], df[col].values)
+    return update_coverage(stats, df)
+
+
+def update_coverage(stats, df):
+    """Accumulate the extremes of the binned columns and the categories."""
+    for col in binned_cols:
+        low, high = stats["minmax"][col]
+        stats["minmax"][col] = (min(low, df[col].min()), max(high, df[col].max()))
+    return update_categories(stats, df)
+
+
+def update_categories(stats, df):
+    for col in stats["categories"]:
+        stats["categories"][col].update(df[col].unique())
+    return stats
+
+
+def fit_from_stats(stats, args):
+    """
+    Build a fitted preprocessing model from accumulated statistics.
+
+    The column transformer is fitted on a small synthetic frame that holds
+    every discovered category, then the bin edges and scaler moments are
+    replaced by the streamed ones, and the number of bins and their one-hot
+    encoder refitted from the edges as `KBinsDiscretizer.fit` would. Hashed
+    columns need no categories.
+    """
+    categories = {col: sorted(stats["categories"][col]) for col in onehot_cols(args)}
+    n_rows = max(2, n_bins + 1, *[len(cats) for cats in categories.values()])
+    synthetic = {col: np.linspace(0, 1, n_rows) for col in binned_cols + scaled_cols}
+    synthetic.update({col: [""] * n_rows for col in args.hash_cols})
+    for col, cats in categories.items():
+        synthetic[col] = [cats[i % len(cats)] for i in range(n_rows)]
+    preprocess = build_preprocess(args)
+    preprocess.fit(pd.DataFrame(synthetic))
+
+    for _, transformer, _ in preprocess.transformers_:
+        if isinstance(transformer, KBinsDiscretizer):
+            bin_edges = np.zeros(len(binned_cols), dtype=object)
+            for i, col in enumerate(binned_cols):
+                edges = sketch_quantiles(
+                    stats["sketches"][col], np.linspace(0, 1, n_bins + 1)
+                )
+                edges[0], edges[-1] = stats["minmax"][col]
+                if drops_narrow_bins:
+                    edges = edges[np.ediff1d(edges, to_begin=np.inf) > 1e-8]
+                bin_edges[i] = edges
+            transformer.bin_edges_ = bin_edges
+            transformer.n_bins_ = np.array([len(edges) - 1 for edges in bin_edges])
+            transformer._encoder = clone(transformer._encoder).set_params(
+                categories=[np.arange(n) for n in transformer.n_bins_]
+            )
+            transformer._encoder.fit(np.zeros((1, len(binned_cols))))
+        elif isinstance(transformer, StandardScaler):
+            transformer.__dict__.update(stats["scaler"].__dict__)
     return preprocess
 
 
+def init_sample():
+    return {
+        "random_state": np.random.RandomState(0),
+        "frame": None,
+        "keys": None,
+        "rows": 0,
+        "category_counts": {col: pd.Series(dtype="int64") for col in categorical_cols},
+    }
+
+
+def update_sample(sample, df, size):
+    """
+    Reservoir sampling over a stream of frames: every row draws a random
+    priority and the `size` rows of lowest priority so far are kept, which
+    is a uniform sample without replacement of all the rows seen. Category
+    counts of all the rows are kept to measure the coverage of the sample.
+    """
+    keys = sample["random_state"].random_sample(len(df))
+    frame = df
+    if sample["frame"] is not None:
+        frame = pd.concat([sample["frame"], df])
+        keys = np.concatenate([sample["keys"], keys])
+    if len(frame) > size:
+        keep = np.argpartition(keys, size - 1)[:size]
+        frame, keys = frame.iloc[keep], keys[keep]
+    sample.update(frame=frame, keys=keys, rows=sample["rows"] + len(df))
+    for col, counts in sample["category_counts"].items():
+        sample["category_counts"][col] = counts.add(
+            df[col].value_counts(), fill_value=0
+        )
+    return sample
+
+
+def fit_sample_stats(stats, sample):
+    """
+    Fit the scaler moments and quantile sketches on the sample. The extremes
+    and categories in `stats` are kept from all the rows, as they are cheap
+    to collect and the transform fails on an unknown category.
+    """
+    return update_fit_stats(stats, sample["frame"])
+
+
+def sample_report(sample, z=1.96):
+    """
+    Bounds on how far a fit on the sample is from a fit on all the rows, at
+    95% confidence with finite population correction:
+
+    - normal intervals of the scaler means and standard deviations,
+    - the quantile (rank) error of each inner bin edge, and the interval of
+      values it spans in the sample,
+    - per categorical column, the share of rows whose category does not
+      occur in the sample and was only known from the full scan.
+    """
+    frame, n_rows = sample["frame"], sample["rows"]
+    n = len(frame)
+    fpc = np.sqrt(max(n_rows - n, 0) / max(n_rows - 1, 1))
+    report = {"sample_rows": n, "rows": n_rows, "confidence": 0.95}
+
+    report["scaler"] = {}
+    for col in scaled_cols:
+        x = frame[col].values.astype(float)
+        mean, std = x.mean(), x.std()
+        mean_error = z * fpc * std / np.sqrt(n)
+        # Delta method on the variance, with the sample fourth moment as the
+        # columns are far from normal
+        m4 = np.mean((x - mean) ** 4)
+        var_se = np.sqrt(max(m4 - std ** 4 * (n - 3) / max(n - 1, 1), 0) / n)
+        std_error = z * fpc * var_se / (2 * std) if std > 0 else 0.0
+        report["scaler"][col] = {
+            "mean": mean,
+            "mean_interval": [mean - mean_error, mean + mean_error],
+            "std": std,
+            "std_interval": [max(std - std_error, 0.0), std + std_error],
+        }
+
+    report["bin_edges"] = {}
+    quantiles = np.linspace(0, 1, n_bins + 1)[1:-1]
+    rank_errors = z * fpc * np.sqrt(quantiles * (1 - quantiles) / n)
+    for col in binned_cols:
+        x = frame[col].values.astype(float)
+        lows = np.percentile(x, 100 * np.clip(quantiles - rank_errors, 0, 1))
+        highs = np.percentile(x, 100 * np.clip(quantiles + rank_errors, 0, 1))
+        report["bin_edges"][col] = {
+            "max_quantile_error": float(rank_errors.max()),
+            "edge_intervals": [[low, high] for low, high in zip(lows, highs)],
+        }
+
+    report["unseen_category_rate"] = {}
+    for col, counts in sample["category_counts"].items():
+        unseen = ~counts.index.isin(frame[col].unique())
+        report["unseen_category_rate"][col] = float(counts[unseen].sum() / n_rows)
+    return report
+
+
+def write_sample_report(sample, args):
+    report = sample_report(sample)
+    output_path = os.path.join(args.data_dir, "model/fit_sample_report.json")
+    print(f"Fitted on {report['sample_rows']} of {report['rows']} rows")
+    print(f"Saving sample fit report to {output_path}")
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def fit_chunks(input_data_path, args):
+    """
+    Fit the preprocessing model out of core, from the training rows of each
+    chunk. Chunks are split the same way as `train_chunks` splits them later.
+
+    Categories are collected from the test rows as well, because a category
+    that only falls into the test split of a chunk would otherwise fail the
+    transform.
+    """
+    print("Creating preprocessing and feature engineering transformations")
+    stats = initial_fit_stats(args)
+    sample = init_sample() if args.fit_sample else None
+    rules = load_data_quality_rules(args)
+    chunks = read_data_chunks(input_data_path, args.chunksize, args.csv_engine, rules)
+    for df in chunks:
+        if df.empty:
+            continue
+        X_train, X_test, _, _ = split_data(df, args)
+        if X_train.empty:
+            # A small chunk may have no training rows with the hash split
+            pass
+        elif sample is None:
+            update_fit_stats(stats, X_train)
+        else:
+            update_sample(sample, X_train, args.fit_sample)
+            update_coverage(stats, X_train)
+        update_categories(stats, X_test)
+    if sample is not None:
+        fit_sample_stats(stats, sample)
+        write_sample_report(sample, args)
+    preprocess = fit_from_stats(stats, args)
+    save_preprocess(preprocess, args, stats)
+    if args.compiled:
+        preprocess = export_compiled(preprocess, args)
+    return preprocess
+
+
+def train_chunks(input_data_path, args):
+    """
+    Fit the preprocessing model in a first pass over the input, then split,
+    transform and write each chunk in a second pass.
+    """
+    if args.feature_format != "csv":
+        raise ValueError("--chunksize is only supported with --feature-format csv")
+    preprocess = fit_chunks(input_data_path, args)
+    n_rows = {"train": 0, "test": 0}
+    shard_rows = {"train": None, "test": None}
+    remove_outputs(args, "train")
+    remove_outputs(args, "test")
+    chunks = read_data_chunks(input_data_path, args.chunksize, args.csv_engine)
+    for df in chunks:
+        if df.empty:
+            continue
+        X_train, X_test, y_train, y_test = split_data(df, args)
+        outputs = []
+        for split, X, y in [("train", X_train, y_train), ("test", X_test, y_test)]:
+            # A split of a small chunk may be empty, and is not transformed
+            if X.empty:
+                continue
+            mode = "a" if n_rows[split] else "w"
+            features = transform(X, args, preprocess)
+            split_files, shard_rows[split] = split_outputs(
+                features, y, args, split, shard_rows[split]
+            )
+            outputs.extend((data, prefix, mode) for data, prefix in split_files)
+            n_rows[split] += features.shape[0]
+        write_outputs(outputs, args)
+    write_manifest(args, "train", shard_rows["train"])
+    write_manifest(args, "test", shard_rows["test"])
+    n_train, n_test = n_rows["train"], n_rows["test"]
+    print(f"Transformed {n_train} train rows and {n_test} test rows")
+    return n_train, n_test
+
+
+def feature_cache_key(input_data_path, args):
+    """
+    Digest of everything the outputs of a run depend on: the raw input, the
+    preprocessing artifact it reads, this script and the output arguments.
+    """
+    if args.mode == "infer":
+        model_file = "proc_compiled.npz" if args.compiled else "proc_model.tar.gz"
+        artifact = os.path.join(args.data_dir, "model", model_file)
+    elif args.refit_from:
+        artifact = os.path.join(args.data_dir, args.refit_from)
+    else:
+        artifact = None
+    key = {
+        "inputs": [file_digest(path) for path in sorted(glob.glob(input_data_path))],
+        "artifact": file_digest(artifact) if artifact else None,
+        "script": file_digest(os.path.abspath(__file__)),
+        "args": {arg: getattr(args, arg) for arg in feature_cache_args},
+        # A restored run skips the data quality gate, so stricter rules miss
+        "rules": load_data_quality_rules(args),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def output_files(args):
+    """Modification time of each file in the output directories of the mode."""
+    files = {}
+    for subdir in feature_cache_outputs[args.mode]:
+        for root, _, names in os.walk(os.path.join(args.data_dir, subdir)):
+            for name in names:
+                path = os.path.join(root, name)
+                files[os.path.relpath(path, args.data_dir)] = os.stat(path).st_mtime_ns
+    return files
+
+
+def restore_features(key, args):
+    """Copy the outputs cached under `key` to the data directory, if any."""
+    fs, root = fsspec.core.url_to_fs(args.feature_cache)
+    entry = f"{root.rstrip('/')}/{key}"
+    if not fs.exists(f"{entry}/cache.json"):
+        return False
+    with fs.open(f"{entry}/cache.json") as f:
+        files = json.load(f)["files"]
+    print(f"Restoring {len(files)} cached outputs from {entry}")
+    for split in ["train", "test"]:
+        if split in feature_cache_outputs[args.mode]:
+            remove_outputs(args, split)
+    for file in files:
+        local_path = os.path.join(args.data_dir, file)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        fs.get(f"{entry}/{file}", local_path)
+    return True
+
+
+def store_features(key, files, args):
+    """Cache the output `files` under `key`, writing the index last."""
+    fs, root = fsspec.core.url_to_fs(args.feature_cache)
+    entry = f"{root.rstrip('/')}/{key}"
+    print(f"Caching {len(files)} outputs to {entry}")
+    for file in files:
+        fs.makedirs(os.path.dirname(f"{entry}/{file}"), exist_ok=True)
+        fs.put(os.path.join(args.data_dir, file), f"{entry}/{file}")
+    with fs.open(f"{entry}/cache.json", "w") as f:
+        json.dump({"files": sorted(files)}, f)
+
+
 def parse_arg():
     parser = argparse.ArgumentParser()
     parser.add_argument("--mode", type=str, default="infer")
     parser.add_argument("--train-test-split-ratio", type=float, default=0.3)
     parser.add_argument("--data-dir", type=str, default="opt/ml/processing")
     parser.add_argument("--data-input", type=str, default="input/census-income.csv")
+    parser.add_argument("--chunksize", type=int, default=None)
+    parser.add_argument("--csv-engine", type=str, default="c", choices=csv_engines)
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument(
+        "--backend", type=str, default="pandas", choices=["pandas", "polars"]
+    )
+    parser.add_argument(
+        "--split-method", type=str, default="random", choices=["random", "hash"]
+    )
+    parser.add_argument("--sparse", action="store_true")
+    parser.add_argument("--compiled", action="store_true")
+    parser.add_argument("--output-shards", type=int, default=1)
+    parser.add_argument("--write-jobs", type=int, default=1)
+    parser.add_argument(
+        "--compression", type=str, default=None, choices=list(compression_extensions)
+    )
+    parser.add_argument("--refit-from", type=str, default=None)
+    parser.add_argument("--fit-sample", type=int, default=None)
+    parser.add_argument("--feature-cache", type=str, default=None)
+    parser.add_argument("--data-quality-rules", type=str, default=None)
+    parser.add_argument(
+        "--dtype", type=str, default="float64", choices=["float32", "float64"]
+    )
+    parser.add_argument(
+        "--hash-cols", type=str, nargs="*", default=[], choices=categorical_cols
+    )
+    parser.add_argument("--hash-features", type=int, default=n_hash_features)
+    parser.add_argument(
+        "--feature-format", type=str, default="csv", choices=list(feature_extensions)
+    )
     args, _ = parser.parse_known_args()
     print(f"Received arguments {args}")
     return args
@@ -123,25 +1460,135 @@ def main(args):
     aws s3 cp $DATA /tmp/input/
     mkdir /tmp/{train,test,model}
     python preprocessing.py --mode "train" --data-dir /tmp
+
+    Large inputs can be scored with bounded memory by streaming them:
+
+    python preprocessing.py --mode "infer" --data-dir /tmp --chunksize 100000
+
+    In train mode, --chunksize also fits the preprocessing model out of core.
+    Add --split-method hash to split rows by their hash instead of shuffling
+    each chunk, so the split does not depend on the chunk size.
+
+    A large input, or a glob of many inputs, can be read on several cores:
+
+    python preprocessing.py --mode "train" --n-jobs 4 --data-input "input/*.csv"
+
+    With --backend polars, the input is read and cleaned by Polars on all
+    cores instead, into the same frame.
+
+    Wide one-hot features can be kept sparse end to end:
+
+    python preprocessing.py --mode "train" --data-dir /tmp --sparse --feature-format npz
+
+    Features can be written as float32 to halve their memory and disk size;
+    pass the same --dtype to train.py, inference.py and evaluation.py:
+
+    python preprocessing.py --mode "train" --data-dir /tmp --dtype float32
+
+    A previous model can be refitted with new data only, by merging the
+    statistics of the new rows into the ones archived with the model:
+
+    python preprocessing.py --mode "train" --data-dir /tmp \\
+        --data-input "input/new.csv" --refit-from "previous/proc_model.tar.gz"
+
+    For quick runs on large inputs, the scaler and bin edges can be fitted on
+    a uniform sample of the training rows. Bounds on the error of the fitted
+    parameters are saved to model/fit_sample_report.json:
+
+    python preprocessing.py --mode "train" --data-dir /tmp --fit-sample 100000
+
+    All the outputs are written concurrently on --write-jobs threads, and CSV
+    outputs can be compressed in parallel blocks:
+
+    python preprocessing.py --mode "train" --write-jobs 4 --compression gzip
+
+    With --output-shards N, each split is written as N balanced part-* files
+    with the label, if any, in the first column, plus a manifest of row counts
+    and checksums, for ShardedByS3Key training and multi-instance batch
+    transform. The outputs of earlier runs in the split directories, sharded
+    or not, are removed first, and train.py, evaluation.py and inference.py
+    read the shards listed in the manifest.
+
+    High-cardinality categorical columns can be hashed into a fixed number
+    of columns instead of one-hot encoded:
+
+    python preprocessing.py --mode "train" --sparse --feature-format npz \\
+        --hash-cols "education" "major industry code" --hash-features 1024
+
+    The raw input is checked against data quality rules before any fitting or
+    writing, and the job fails with a report of every violation. The default
+    rules can be updated per rule from a JSON file:
+
+    python preprocessing.py --mode "train" --data-quality-rules "rules.json"
+
+    {"rows": [100000, null], "ranges": {"age": [0, 120]},
+     "categories": {"class of worker": [" Private", " Self-employed"]}}
+
+    In chunked modes each chunk is checked as it is read, and the row count
+    and null ratios of the whole input after the last one.
+
+    With --compiled, train mode also exports the fitted model as numpy arrays
+    to model/proc_compiled.npz and both modes transform with those arrays.
+
+    With --feature-cache, the outputs of a run are cached in a local directory
+    or an S3 prefix, keyed by the digests of the input, the preprocessing
+    model and this script, and restored instead of recomputed on a re-run:
+
+    python preprocessing.py --mode "infer" --feature-cache s3://bucket/features
     """
     input_data_path = os.path.join(args.data_dir, args.data_input)
-    df = read_data(input_data_path)
+    if not args.feature_cache:
+        return process(input_data_path, args)
+    if fsspec is None:
+        raise ImportError("--feature-cache requires fsspec")
+
+    key = feature_cache_key(input_data_path, args)
+    if restore_features(key, args):
+        return None
+    before = output_files(args)
+    outputs = process(input_data_path, args)
+    after = output_files(args)
+    store_features(key, [f for f in after if after[f] != before.get(f)], args)
+    return outputs
+
+
+def process(input_data_path, args):
+    if args.mode == "infer" and args.chunksize:
+        return transform_chunks(input_data_path, args)
+    elif args.mode == "train" and args.chunksize:
+        return train_chunks(input_data_path, args)
+
+    df = read_data(
+        input_data_path,
+        args.csv_engine,
+        args.n_jobs,
+        args.backend,
+        load_data_quality_rules(args),
+    )
 
     if args.mode == "infer":
         test_features = transform(df, args)
-        write_data(test_features, args, "test/test_features.csv")
-        if target_col in df.columns:
-            write_data(df[target_col], args, "test/test_labels.csv")
+        labels = df[target_col] if target_col in df.columns else None
+        remove_outputs(args, "test")
+        shard_rows = write_split(test_features, labels, args, "test")
+        write_manifest(args, "test", shard_rows, labels is not None)
         return test_features
     elif args.mode == "train":
         X_train, X_test, y_train, y_test = split_data(df, args)
         preprocess = fit(X_train, args)
+        if args.compiled:
+            preprocess = export_compiled(preprocess, args)
         train_features = transform(X_train, args, preprocess)
         test_features = transform(X_test, args, preprocess)
-        write_data(train_features, args, "train/train_features.csv")
-        write_data(y_train, args, "train/train_labels.csv")
-        write_data(test_features, args, "test/test_features.csv")
-        write_data(y_test, args, "test/test_labels.csv")
+        train_outputs, train_rows = split_outputs(
+            train_features, y_train, args, "train"
+        )
+        test_outputs, test_rows = split_outputs(test_features, y_test, args, "test")
+        remove_outputs(args, "train")
+        remove_outputs(args, "test")
+        write_outputs(train_outputs + test_outputs, args)
+        write_manifest(args, "train", train_rows)
+        write_manifest(args, "test", test_rows)
         return train_features, test_features
 
 
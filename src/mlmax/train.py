@@ -1,20 +1,288 @@
 import argparse
+import glob
+import hashlib
+import io
+import json
 import os
+import socket
+import tarfile
+import tempfile
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import (
+    Client,
+    Connection,
+    answer_challenge,
+    deliver_challenge,
+)
 
+import numpy as np
 import pandas as pd
-from sklearn.linear_model import LogisticRegression
-from sklearn.metrics import accuracy_score, classification_report, roc_auc_score
+from scipy import sparse
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.metrics import (
+    accuracy_score,
+    classification_report,
+    log_loss,
+    roc_auc_score,
+)
+from sklearn.model_selection import ParameterGrid
 
 try:
     from sklearn.externals import joblib
 except ImportError:
     import joblib
+try:
+    # Needed before scikit-learn 1.0
+    from sklearn.experimental import enable_hist_gradient_boosting  # noqa: F401
+except ImportError:
+    pass
+try:
+    from sklearn.ensemble import HistGradientBoostingClassifier
+except ImportError:
+    HistGradientBoostingClassifier = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    from pyarrow import feather
+except ImportError:
+    feather = None
+
+
+feature_extensions = {
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "feather": ".feather",
+    "npy": ".npy",
+    "npz": ".npz",
+}
 
+search_grid = [
+    {
+        "solver": ["lbfgs"],
+        "penalty": ["l2"],
+        "C": [0.01, 0.1, 1.0, 10.0],
+        "class_weight": [None, "balanced"],
+    },
+    {
+        "solver": ["liblinear", "saga"],
+        "penalty": ["l1", "l2"],
+        "C": [0.01, 0.1, 1.0, 10.0],
+        "class_weight": [None, "balanced"],
+    },
+]
+search_validation_ratio = 0.2
+candidate_estimators = {
+    "lr": (LogisticRegression, {"class_weight": "balanced", "solver": "lbfgs"}),
+    "sgd": (
+        SGDClassifier,
+        {
+            "loss": "log",
+            "class_weight": "balanced",
+            "max_iter": 1000,
+            "tol": 1e-3,
+            "random_state": 0,
+        },
+    ),
+    "hgb": (HistGradientBoostingClassifier, {"random_state": 0}),
+}
+search_min_rows = 20
+averaging_connect_timeout = 600
+checkpoint_args = [
+    "feature_format",
+    "dtype",
+    "chunksize",
+    "epochs",
+    "tol",
+    "n_iter_no_change",
+]
+_file_digests = {}
+
+
+def read_matrix(path, feature_format="csv", dense=False, dtype=None):
+    """
+    Read a headerless feature or label file written by preprocessing.py,
+    cast to `dtype` if given.
+
+    Sparse `npz` files are returned as CSR matrices unless `dense` is set.
+    CSV files may be compressed with gzip (`.gz`) or zstd (`.zst`).
+    """
+    if feature_format == "npz":
+        X = sparse.load_npz(path)
+        if dtype is not None:
+            X = X.astype(dtype, copy=False)
+        return pd.DataFrame(X.toarray()) if dense else X
+    if feature_format == "csv" and path.endswith(".zst"):
+        with open(path, "rb") as f:
+            reader = zstandard.ZstdDecompressor().stream_reader(
+                f, read_across_frames=True
+            )
+            return pd.read_csv(reader, header=None, dtype=dtype)
+    if feature_format == "csv":
+        return pd.read_csv(path, header=None, dtype=dtype)
+    if feature_format == "npy":
+        X = np.load(path)
+        return pd.DataFrame(X if dtype is None else X.astype(dtype, copy=False))
+    df = getattr(pd, f"read_{feature_format}")(path)
+    df.columns = range(df.shape[1])
+    return df if dtype is None else df.astype(dtype, copy=False)
+
+
+def read_mmap(path, feature_format="npy", dtype=None):
+    """
+    Read a `npy` or Arrow `feather` file into a C-contiguous array without an
+    intermediate DataFrame, so it can be passed straight to `model.fit`.
+
+    `npy` files are memory mapped and returned without a copy unless they
+    have to be cast to `dtype`. Arrow stores columns separately, so the
+    memory-mapped columns of `feather` files are copied once into a
+    row-major array.
+    """
+    if feature_format == "npy":
+        X = np.load(path, mmap_mode="r")
+        return np.require(X, dtype=dtype, requirements="C")
+    if feature_format != "feather":
+        raise ValueError("Memory-mapped reads support npy or feather files only")
+    if feather is None:
+        raise ImportError("pyarrow is required to memory map feather files")
+    table = feather.read_table(path, memory_map=True)
+    if dtype is None:
+        dtype = np.result_type(*[t.to_pandas_dtype() for t in table.schema.types])
+    X = np.empty((table.num_rows, table.num_columns), dtype=dtype)
+    for i, column in enumerate(table.columns):
+        X[:, i] = column.to_numpy()
+    return X
 
-def read_xy(data_dir, mode="train"):
+
+def with_compression(path):
+    """`path`, or the compressed file written in its place."""
+    for suffix in ["", ".gz", ".zst"]:
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return path
+
+
+def file_digest(path, block_size=1 << 20):
+    """SHA-256 of a file, memoized on its path, size and modification time."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_digests:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                sha.update(block)
+        _file_digests[key] = sha.hexdigest()
+    return _file_digests[key]
+
+
+def is_sharded(data_dir, split, feature_format="csv"):
+    """
+    Whether a split was written as `part-*` shards by `--output-shards`
+    rather than as `{split}_features` and `{split}_labels` files. A directory
+    holding both, as left by runs with different `--output-shards`, is
+    refused rather than read as either.
+    """
+    ext = feature_extensions[feature_format]
+    features_path = with_compression(os.path.join(data_dir, f"{split}_features{ext}"))
+    has_features = os.path.exists(features_path)
+    has_shards = os.path.exists(
+        os.path.join(data_dir, f"{split}_manifest.json")
+    ) or bool(glob.glob(os.path.join(data_dir, f"part-*{ext}*")))
+    if has_features and has_shards:
+        raise ValueError(
+            f"{data_dir} holds both {os.path.basename(features_path)} and part-*"
+            " shards of different runs"
+        )
+    return not has_features
+
+
+def shard_paths(data_dir, split, feature_format="csv"):
+    """
+    The non-empty `part-*` files of a sharded split as `(path, rows)` pairs,
+    and whether they hold the label in their first column. The shards listed
+    in the manifest of the split are checked against their checksums, and
+    unlisted ones ignored. With ShardedByS3Key, a host may receive only some
+    of the shards and no manifest, and then reads every shard it received.
+    """
+    ext = feature_extensions[feature_format]
+    manifest_path = os.path.join(data_dir, f"{split}_manifest.json")
+    if not os.path.exists(manifest_path):
+        paths = sorted(glob.glob(os.path.join(data_dir, f"part-*{ext}*")))
+        return [(path, None) for path in paths if os.path.getsize(path)], True
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    shards = []
+    for shard in manifest["shards"]:
+        path = os.path.join(data_dir, shard["file"])
+        if not shard["rows"] or not os.path.exists(path):
+            continue
+        if file_digest(path) != shard["sha256"]:
+            raise ValueError(f"Checksum of {path} does not match {manifest_path}")
+        shards.append((path, shard["rows"]))
+    return shards, manifest.get("labels", True)
+
+
+def read_shards(data_dir, split, feature_format="csv", dtype=None):
+    """
+    Read the `part-*` files of a split written with `--output-shards`, which
+    hold the label in the first column followed by the features. The labels
+    are None if the split was written without any.
+    """
+    shards, has_labels = shard_paths(data_dir, split, feature_format)
+    parts = []
+    for path, rows in shards:
+        part = read_matrix(path, feature_format, dtype=dtype)
+        if rows is not None and part.shape[0] != rows:
+            raise ValueError(f"{path} has {part.shape[0]} rows, not {rows}")
+        parts.append(part)
+    if not parts:
+        raise ValueError(
+            f"No non-empty {split} shards in {data_dir}; with ShardedByS3Key,"
+            " use at most as many hosts as there are shards"
+        )
+    if sparse.issparse(parts[0]):
+        data = sparse.vstack(parts, format="csr")
+    else:
+        data = pd.concat(parts, ignore_index=True)
+    if not has_labels:
+        return data, None
+    if sparse.issparse(data):
+        X, y = data[:, 1:], pd.DataFrame(data[:, 0].toarray())
+    else:
+        X, y = data.iloc[:, 1:], data.iloc[:, [0]]
+        X.columns = range(X.shape[1])
+        y.columns = [0]
+    return X, y.astype("int64")
+
+
+def read_xy(data_dir, mode="train", feature_format="csv", dtype=None, mmap=False):
+    """
+    Read the features and labels of a split. With `mmap`, `npy` and `feather`
+    files are read by `read_mmap` as arrays, the labels flattened to 1-D.
+    """
     print(f"Reading {mode} data from {data_dir}")
-    X = pd.read_csv(os.path.join(data_dir, f"{mode}_features.csv"), header=None)
-    y = pd.read_csv(os.path.join(data_dir, f"{mode}_labels.csv"), header=None)
+    ext = feature_extensions[feature_format]
+    features_path = with_compression(os.path.join(data_dir, f"{mode}_features{ext}"))
+    if is_sharded(data_dir, mode, feature_format):
+        X, y = read_shards(data_dir, mode, feature_format, dtype)
+        if y is None:
+            raise ValueError(f"The {mode} shards in {data_dir} have no labels")
+        return X, y
+    if mmap:
+        X = read_mmap(features_path, feature_format, dtype=dtype)
+        y = read_mmap(os.path.join(data_dir, f"{mode}_labels{ext}"), feature_format)
+        return X, y.ravel()
+    X = read_matrix(features_path, feature_format, dtype=dtype)
+    y = read_matrix(
+        with_compression(os.path.join(data_dir, f"{mode}_labels{ext}")),
+        feature_format,
+        dense=True,
+    )
     return X, y
 
 
@@ -24,21 +292,639 @@ def read_processed_data(args):
         /opt/ml/input/data/train
         /opt/ml/input/data/test
     """
-    X_train, y_train = read_xy(args.train, "train")
-    X_test, y_test = read_xy(args.test, "test")
+    X_train, y_train = read_xy(
+        args.train, "train", args.feature_format, args.dtype, args.mmap
+    )
+    X_test, y_test = read_xy(
+        args.test, "test", args.feature_format, args.dtype, args.mmap
+    )
     return X_train, y_train, X_test, y_test
 
 
+def load_warm_start_model(path):
+    """Load the `model.joblib` of a previous `model.tar.gz`, or a joblib file."""
+    print(f"Loading warm start model from {path}")
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path) as archive:
+            return joblib.load(archive.extractfile("model.joblib"))
+    return joblib.load(path)
+
+
+def warm_start(model, previous, X_train, y_train):
+    """
+    Initialize the solver of `model` with the coefficients of `previous`.
+    Returns False, leaving `model` to a cold start, if `previous` is not a
+    LogisticRegression fitted on the same features and classes.
+    """
+    n_features = X_train.shape[1]
+    classes = np.unique(np.asarray(y_train))
+    if (
+        not isinstance(previous, LogisticRegression)
+        or previous.coef_.shape != (1, n_features)
+        or not np.array_equal(previous.classes_, classes)
+    ):
+        print("Feature layout changed since the warm start model, cold starting")
+        return False
+    model.set_params(warm_start=True)
+    model.coef_ = previous.coef_.copy()
+    model.intercept_ = previous.intercept_.copy()
+    return True
+
+
+def fit_timed(model, X_train, y_train, start_kind):
+    start = time.perf_counter()
+    model.fit(X_train, y_train)
+    print(
+        f"{start_kind} start converged in {model.n_iter_.max()} iterations"
+        f" and {time.perf_counter() - start:.3f}s"
+    )
+    return model
+
+
 def train(X_train, y_train, args):
     model = LogisticRegression(class_weight="balanced", solver="lbfgs")
     print("Training LR model")
+    warm_start_model = getattr(args, "warm_start_model", None)
+    if not warm_start_model:
+        model.fit(X_train, y_train)
+        return model
+    previous = load_warm_start_model(warm_start_model)
+    start_kind = "Warm" if warm_start(model, previous, X_train, y_train) else "Cold"
+    fit_timed(model, X_train, y_train, start_kind)
+    if start_kind == "Warm" and args.compare_cold_start:
+        cold_model = LogisticRegression(class_weight="balanced", solver="lbfgs")
+        fit_timed(cold_model, X_train, y_train, "Cold")
+    return model
+
+
+def share_arrays(X, y, tmp_dir):
+    """
+    Paths of `.npy` files holding `X` and `y`, which processes can memory map
+    instead of receiving copies. A memory-mapped `X` is shared as is.
+    """
+    features_path = getattr(X, "filename", None)
+    if not features_path or not isinstance(X, np.memmap):
+        features_path = os.path.join(tmp_dir, "features.npy")
+        np.save(features_path, X.toarray() if sparse.issparse(X) else np.asarray(X))
+    labels_path = os.path.join(tmp_dir, "labels.npy")
+    np.save(labels_path, np.asarray(y).ravel())
+    return features_path, labels_path
+
+
+def fit_candidate(task):
+    """
+    Fit `LogisticRegression(**params)` on `train_rows` of the memory-mapped
+    training data and return its ROC AUC on `validation_rows`.
+    """
+    params, features_path, labels_path, train_rows, validation_rows = task
+    X = np.load(features_path, mmap_mode="r")
+    y = np.load(labels_path, mmap_mode="r")
+    model = LogisticRegression(random_state=0, **params)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", ConvergenceWarning)
+            model.fit(X[train_rows], y[train_rows])
+    except ValueError:
+        # A small subset may hold a single class
+        return float("nan")
+    probas = model.predict_proba(X[validation_rows])[:, 1]
+    return roc_auc_score(y[validation_rows], probas)
+
+
+def validation_split(y_train):
+    """
+    Hold out `search_validation_ratio` of the training rows for validation.
+    Both sets of rows are in a random order in which every prefix, and so
+    every subset, is stratified by class.
+    """
+    rows = np.random.RandomState(0).permutation(len(y_train))
+    # Order the rows by their rank within their class
+    labels = pd.Series(y_train[rows])
+    class_rank = labels.groupby(labels).cumcount() / labels.map(labels.value_counts())
+    rows = rows[np.argsort(class_rank.values, kind="stable")]
+    n_validation = int(len(rows) * search_validation_ratio)
+    return rows[n_validation:], rows[:n_validation]
+
+
+def search(X_train, y_train, args):
+    """
+    Pick the `search_grid` candidate with the best validation ROC AUC by
+    successive halving: all candidates are fitted on a small random subset
+    of the training rows, and each round keeps the best 1 / `halving_factor`
+    on a subset `halving_factor` times larger, up to all training rows.
+    Candidates run on `args.search_jobs` processes which share the training
+    data through a memory-mapped file.
+
+    Returns the best candidate refitted on all rows, and the search report.
+    """
+    candidates = list(ParameterGrid(search_grid))
+    y_train = np.asarray(y_train).ravel()
+    train_rows, validation_rows = validation_split(y_train)
+    n_rounds = max(
+        1, int(np.ceil(np.log(len(candidates)) / np.log(args.halving_factor)))
+    )
+    report = {"n_candidates": len(candidates), "rounds": []}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        features_path, labels_path = share_arrays(X_train, y_train, tmp_dir)
+        with ProcessPoolExecutor(max_workers=args.search_jobs) as executor:
+            for i in range(n_rounds):
+                n_rows = len(train_rows) // args.halving_factor ** (n_rounds - 1 - i)
+                n_rows = max(n_rows, min(len(train_rows), search_min_rows))
+                tasks = [
+                    (
+                        params,
+                        features_path,
+                        labels_path,
+                        train_rows[:n_rows],
+                        validation_rows,
+                    )
+                    for params in candidates
+                ]
+                scores = list(executor.map(fit_candidate, tasks))
+                print(
+                    f"Round {i + 1}: {len(candidates)} candidates on {n_rows} rows,"
+                    f" best ROC AUC {np.nanmax(scores + [np.nan]):.4f}"
+                )
+                report["rounds"].append(
+                    {
+                        "n_rows": int(n_rows),
+                        "candidates": [
+                            {"params": params, "roc_auc": score}
+                            for params, score in zip(candidates, scores)
+                        ],
+                    }
+                )
+                ranks = np.argsort(-np.nan_to_num(scores, nan=-np.inf), kind="stable")
+                n_keep = int(np.ceil(len(candidates) / args.halving_factor))
+                best_score = scores[ranks[0]]
+                candidates = [candidates[j] for j in ranks[:n_keep]]
+    best_params = candidates[0]
+    report["best_params"] = best_params
+    report["best_roc_auc"] = best_score
+    print(f"Refitting best candidate {best_params} on all rows")
+    model = LogisticRegression(random_state=0, **best_params)
     model.fit(X_train, y_train)
+    return model, report
+
+
+def save_search_report(report, args):
+    output_path = os.path.join(args.model_dir, "search_report.json")
+    print(f"Saving search report to {output_path}")
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def averaging_authkey(args):
+    """
+    The secret the hosts of a training job authenticate each other with: a
+    digest of the job name and the `args.averaging_token` hyperparameter.
+    """
+    if not args.averaging_token:
+        raise ValueError("Training on several hosts requires --averaging-token")
+    job_name = os.environ.get("TRAINING_JOB_NAME", "")
+    return hashlib.sha256(f"{job_name}:{args.averaging_token}".encode()).digest()
+
+
+def connect_hosts(args):
+    """
+    Connect the first of the sorted `args.hosts`, which averages the models,
+    to all other hosts. Returns its connections to the other hosts on the
+    first host, and the connection to the first host on the others. Either
+    side gives up after `averaging_connect_timeout` seconds.
+    """
+    hosts = sorted(args.hosts)
+    address = (args.averaging_host or hosts[0], args.averaging_port)
+    authkey = averaging_authkey(args)
+    deadline = time.time() + averaging_connect_timeout
+    if args.current_host == hosts[0]:
+        connections = []
+        with socket.socket() as server:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(address)
+            server.listen()
+            print(f"Waiting for {len(hosts) - 1} hosts on {address}")
+            try:
+                while len(connections) < len(hosts) - 1:
+                    server.settimeout(max(deadline - time.time(), 0.001))
+                    sock, peer = server.accept()
+                    sock.setblocking(True)
+                    conn = Connection(sock.detach())
+                    try:
+                        # The handshake of multiprocessing.connection.Listener
+                        deliver_challenge(conn, authkey)
+                        answer_challenge(conn, authkey)
+                    except (AuthenticationError, EOFError, OSError):
+                        print(f"Rejected connection from {peer}")
+                        conn.close()
+                        continue
+                    connections.append(conn)
+            except socket.timeout:
+                for conn in connections:
+                    conn.close()
+                raise TimeoutError(
+                    f"Only {len(connections)} of {len(hosts) - 1} hosts connected"
+                    f" to {address} within {averaging_connect_timeout} seconds"
+                )
+        return connections
+    while True:
+        try:
+            return [Client(address, authkey=authkey)]
+        except ConnectionRefusedError:
+            # The first host may not be listening yet
+            if time.time() > deadline:
+                raise
+            time.sleep(1)
+
+
+def send_array(conn, array):
+    """Send an array as raw float64 bytes, rather than as a pickle."""
+    conn.send_bytes(np.ascontiguousarray(array, dtype="float64").tobytes())
+
+
+def recv_array(conn, size):
+    """Receive an array of `size` float64 values sent by `send_array`."""
+    array = np.frombuffer(conn.recv_bytes(8 * size), dtype="float64")
+    if array.size != size:
+        raise ValueError(f"Received {array.size} values instead of {size}")
+    return array
+
+
+def average_models(model, n_rows, connections, args):
+    """
+    Replace the coefficients of `model` by their average over all hosts,
+    weighted by the number of rows each host trained on. The coefficients,
+    intercepts and row counts are exchanged as flat float64 arrays.
+    """
+    coef_size = model.coef_.size
+    params = np.concatenate([model.coef_.ravel(), model.intercept_, [n_rows]])
+    if args.current_host == sorted(args.hosts)[0]:
+        all_params = [params] + [recv_array(c, params.size) for c in connections]
+        all_params = np.vstack(all_params)
+        average = np.average(all_params[:, :-1], axis=0, weights=all_params[:, -1])
+        for conn in connections:
+            send_array(conn, average)
+    else:
+        send_array(connections[0], params)
+        average = recv_array(connections[0], params.size - 1)
+    model.coef_ = average[:coef_size].reshape(model.coef_.shape)
+    model.intercept_ = average[coef_size:]
+    return model
+
+
+def train_data_parallel(X_train, y_train, args):
+    """
+    Train on the shard of this host, `args.current_host`, and average the
+    model with those of the other `args.hosts` for `args.averaging_rounds`
+    rounds. After the first round, each host resumes from the average with
+    at most `args.local_max_iter` solver iterations. A single round is a
+    one-shot merge of the fully trained shard models.
+    """
+    print(f"Training on {X_train.shape[0]} rows of host {args.current_host}")
+    connections = connect_hosts(args)
+    model = LogisticRegression(
+        class_weight="balanced", solver="lbfgs", max_iter=args.local_max_iter
+    )
+    try:
+        for i in range(args.averaging_rounds):
+            model.set_params(warm_start=i > 0)
+            model.fit(X_train, y_train)
+            average_models(model, X_train.shape[0], connections, args)
+            print(f"Averaged models of {len(args.hosts)} hosts, round {i + 1}")
+    finally:
+        for conn in connections:
+            conn.close()
     return model
 
 
+def fit_estimator(task):
+    """
+    Fit a `candidate_estimators` entry on `train_rows` of memory-mapped
+    training data to score it on `validation_rows`, then on all the rows.
+    Returns the model fitted on all rows, the times of both fits and the
+    validation ROC AUC.
+    """
+    name, features_path, labels_path, train_rows, validation_rows = task
+    estimator_class, params = candidate_estimators[name]
+    X = np.load(features_path, mmap_mode="r")
+    y = np.load(labels_path, mmap_mode="r")
+    start = time.perf_counter()
+    model = estimator_class(**params).fit(X[train_rows], y[train_rows])
+    validation_fit_seconds = time.perf_counter() - start
+    probas = model.predict_proba(X[validation_rows])[:, 1]
+    validation_roc_auc = roc_auc_score(y[validation_rows], probas)
+    start = time.perf_counter()
+    model = estimator_class(**params).fit(X, y)
+    refit_seconds = time.perf_counter() - start
+    return model, validation_fit_seconds, refit_seconds, validation_roc_auc
+
+
+def train_estimators(X_train, y_train, args):
+    """
+    Fit the `args.estimators` candidates concurrently, one process each up
+    to the number of cores, on training data shared through a memory-mapped
+    file, and score them on rows held out from it.
+    """
+    for name in args.estimators:
+        if candidate_estimators[name][0] is None:
+            raise ImportError(f"Estimator {name} needs a newer scikit-learn")
+    print(f"Training {', '.join(args.estimators)} models")
+    y_train = np.asarray(y_train).ravel()
+    train_rows, validation_rows = validation_split(y_train)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        features_path, labels_path = share_arrays(X_train, y_train, tmp_dir)
+        tasks = [
+            (name, features_path, labels_path, train_rows, validation_rows)
+            for name in args.estimators
+        ]
+        max_workers = min(len(tasks), os.cpu_count())
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(args.estimators, executor.map(fit_estimator, tasks)))
+
+
+def save_leaderboard(fitted, X_test, y_test, args):
+    """
+    Evaluate and save every fitted candidate as `model-<name>.joblib`, save
+    the best by validation ROC AUC as `model.joblib`, and rank them all in
+    `leaderboard.json`. Test metrics are reported only, so that the test set
+    stays unbiased for the evaluation of the selected model.
+    """
+    leaderboard = []
+    for name, (model, *fit_seconds, validation_roc_auc) in fitted.items():
+        report_dict = evaluate(model, X_test, y_test, args)
+        artifact = f"model-{name}.joblib"
+        joblib.dump(model, os.path.join(args.model_dir, artifact))
+        leaderboard.append(
+            {
+                "estimator": name,
+                "artifact": artifact,
+                "validation_fit_seconds": fit_seconds[0],
+                "refit_seconds": fit_seconds[1],
+                "fit_seconds": sum(fit_seconds),
+                "validation_roc_auc": validation_roc_auc,
+                "test_accuracy": report_dict["accuracy"],
+                "test_roc_auc": report_dict["roc_auc"],
+                "test_macro_f1": report_dict["macro avg"]["f1-score"],
+            }
+        )
+    leaderboard.sort(key=lambda entry: entry["validation_roc_auc"], reverse=True)
+    save_model(fitted[leaderboard[0]["estimator"]][0], args)
+    output_path = os.path.join(args.model_dir, "leaderboard.json")
+    print(f"Saving leaderboard to {output_path}")
+    with open(output_path, "w") as f:
+        json.dump(leaderboard, f, indent=2)
+    return leaderboard
+
+
+def chunk_offsets(path, chunksize):
+    """
+    Byte offsets of every `chunksize`-th line of a headerless csv file,
+    starting at 0 and ending at the file size.
+    """
+    offsets = [0]
+    with open(path, "rb") as f:
+        n_lines = 0
+        for line in iter(f.readline, b""):
+            n_lines += 1
+            if n_lines % chunksize == 0:
+                offsets.append(f.tell())
+        if offsets[-1] != f.tell():
+            offsets.append(f.tell())
+    return offsets
+
+
+def chunk_specs(data_dir, mode="train", feature_format="csv", chunksize=100000):
+    """
+    Split the features of a split into chunks that can be read in any order,
+    as `(features_path, labels_path, start, end)` tuples. Ranges are bytes for
+    csv and rows for npy files. Shards written with `--output-shards` hold
+    the label in their first column and have no labels path.
+    """
+    if feature_format not in ["csv", "npy"]:
+        raise ValueError("Streaming training reads csv or npy features only")
+    ext = feature_extensions[feature_format]
+    features_path = os.path.join(data_dir, f"{mode}_features{ext}")
+    if not is_sharded(data_dir, mode, feature_format):
+        pairs = [(features_path, os.path.join(data_dir, f"{mode}_labels{ext}"))]
+    else:
+        shards, has_labels = shard_paths(data_dir, mode, feature_format)
+        if not has_labels:
+            raise ValueError(f"The {mode} shards in {data_dir} have no labels")
+        pairs = [(path, None) for path, _ in shards]
+    specs = []
+    for features_path, labels_path in pairs:
+        if features_path.endswith((".gz", ".zst")):
+            raise ValueError("Streaming training cannot seek in compressed files")
+        if feature_format == "npy":
+            n_rows = np.load(features_path, mmap_mode="r").shape[0]
+            bounds = list(range(0, n_rows, chunksize)) + [n_rows]
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                specs.append((features_path, labels_path, start, end))
+            continue
+        feature_bounds = chunk_offsets(features_path, chunksize)
+        label_bounds = (
+            chunk_offsets(labels_path, chunksize)
+            if labels_path
+            else [None] * len(feature_bounds)
+        )
+        for i in range(len(feature_bounds) - 1):
+            specs.append(
+                (
+                    features_path,
+                    labels_path,
+                    feature_bounds[i : i + 2],
+                    label_bounds[i : i + 2],
+                )
+            )
+    return specs
+
+
+def read_csv_range(path, bounds, dtype=None, usecols=None):
+    """Read the lines of a headerless csv file within a byte range."""
+    with open(path, "rb") as f:
+        f.seek(bounds[0])
+        data = f.read(bounds[1] - bounds[0])
+    return pd.read_csv(
+        io.BytesIO(data), header=None, dtype=dtype, usecols=usecols
+    ).values
+
+
+def read_chunk(spec, feature_format="csv", dtype=None):
+    """Read the features and labels of a chunk from `chunk_specs`."""
+    features_path, labels_path, start, end = spec
+    if feature_format == "npy":
+        X = np.asarray(np.load(features_path, mmap_mode="r")[start:end], dtype=dtype)
+        y = np.load(labels_path, mmap_mode="r")[start:end] if labels_path else X[:, 0]
+    else:
+        X = read_csv_range(features_path, start, dtype)
+        y = read_csv_range(labels_path, end) if labels_path else X[:, 0]
+    if not labels_path:
+        X = X[:, 1:]
+    return X, np.asarray(y).ravel().astype("int64")
+
+
+def read_chunk_labels(spec, feature_format="csv"):
+    """
+    Read only the labels of a chunk: its labels file, or the first column of
+    a shard, without parsing the features.
+    """
+    features_path, labels_path, start, end = spec
+    if feature_format == "npy":
+        if labels_path:
+            y = np.load(labels_path, mmap_mode="r")[start:end]
+        else:
+            y = np.load(features_path, mmap_mode="r")[start:end, 0]
+    elif labels_path:
+        y = read_csv_range(labels_path, end)
+    else:
+        y = read_csv_range(features_path, start, usecols=[0])
+    return np.asarray(y).ravel().astype("int64")
+
+
+def balanced_class_weight(specs, feature_format="csv"):
+    """The `class_weight="balanced"` weights, counted over all chunks."""
+    counts = pd.Series(dtype="int64")
+    for spec in specs:
+        y = read_chunk_labels(spec, feature_format)
+        counts = counts.add(pd.Series(y).value_counts(), fill_value=0)
+    n_samples, n_classes = counts.sum(), len(counts)
+    return {
+        int(label): n_samples / (n_classes * count) for label, count in counts.items()
+    }
+
+
+def predict_chunks(model, specs, args):
+    """Labels, predictions and positive class probabilities of all chunks."""
+    y_true, predictions, probas = [], [], []
+    for spec in specs:
+        X, y = read_chunk(spec, args.feature_format, args.dtype)
+        y_true.append(y)
+        predictions.append(model.predict(X))
+        probas.append(model.predict_proba(X)[:, 1])
+    return np.concatenate(y_true), np.concatenate(predictions), np.concatenate(probas)
+
+
+def checkpoint_key(train_specs, test_specs, args):
+    """
+    Everything a checkpoint of `train_chunks` depends on: the SHA-256 of each
+    data file, the chunks they are split into and the training arguments.
+    """
+    paths = sorted(
+        {path for spec in train_specs + test_specs for path in spec[:2] if path}
+    )
+    return {
+        "files": [(os.path.basename(path), file_digest(path)) for path in paths],
+        "n_chunks": (len(train_specs), len(test_specs)),
+        "args": {arg: getattr(args, arg) for arg in checkpoint_args},
+    }
+
+
+def load_checkpoint(args, key):
+    """
+    The training state saved in `args.checkpoint_dir` by an interrupted run
+    of `train_chunks`, or None if there is none with the same `key`.
+    """
+    if not args.checkpoint_dir:
+        return None
+    checkpoint_path = os.path.join(args.checkpoint_dir, "checkpoint.joblib")
+    if not os.path.exists(checkpoint_path):
+        return None
+    state = joblib.load(checkpoint_path)
+    if state.get("key") != key:
+        print(f"Ignoring checkpoint {checkpoint_path} of other data or arguments")
+        return None
+    print(
+        f"Resuming from {checkpoint_path} at epoch {state['epoch'] + 1},"
+        f" chunk {state['offset']}"
+    )
+    return state
+
+
+def save_checkpoint(state, args):
+    """
+    Save the training state to `args.checkpoint_dir`, replacing the previous
+    checkpoint atomically so that an interruption never leaves a partial one.
+    """
+    if not args.checkpoint_dir:
+        return
+    checkpoint_path = os.path.join(args.checkpoint_dir, "checkpoint.joblib")
+    joblib.dump(state, checkpoint_path + ".tmp")
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+
+def remove_checkpoint(args):
+    """
+    Remove the checkpoint of a finished run once its model is saved, so that
+    a later job sharing `args.checkpoint_dir` starts afresh.
+    """
+    if not args.checkpoint_dir:
+        return
+    checkpoint_path = os.path.join(args.checkpoint_dir, "checkpoint.joblib")
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+def train_chunks(args):
+    """
+    Train an `SGDClassifier` with logistic loss out of core, one chunk of
+    `args.chunksize` rows at a time, visiting the chunks in a new random order
+    each epoch. Training stops after `args.epochs` epochs, or once the test
+    log loss has improved by less than `args.tol` for `args.n_iter_no_change`
+    epochs in a row.
+
+    The model, epoch and number of chunks trained in the epoch are saved to
+    `args.checkpoint_dir` every `args.checkpoint_every` chunks and at the end
+    of each epoch, and training resumes from there when restarted with the
+    same data and arguments.
+    """
+    train_specs = chunk_specs(args.train, "train", args.feature_format, args.chunksize)
+    test_specs = chunk_specs(args.test, "test", args.feature_format, args.chunksize)
+    class_weight = balanced_class_weight(train_specs, args.feature_format)
+    classes = np.array(sorted(class_weight))
+    key = checkpoint_key(train_specs, test_specs, args)
+    state = load_checkpoint(args, key) or {
+        "model": SGDClassifier(loss="log", class_weight=class_weight, random_state=0),
+        "epoch": 0,
+        "offset": 0,
+        "best_loss": np.inf,
+        "n_no_change": 0,
+        "converged": False,
+        "key": key,
+    }
+    model = state["model"]
+    print(f"Training SGD model on {len(train_specs)} chunks")
+    while state["epoch"] < args.epochs and not state["converged"]:
+        # Seeded by epoch, so that a resumed epoch visits the same chunks
+        order = np.random.RandomState(state["epoch"]).permutation(len(train_specs))
+        for i in order[state["offset"] :]:
+            X, y = read_chunk(train_specs[i], args.feature_format, args.dtype)
+            model.partial_fit(X, y, classes=classes)
+            state["offset"] += 1
+            if state["offset"] % args.checkpoint_every == 0:
+                save_checkpoint(state, args)
+        y_test, _, probas = predict_chunks(model, test_specs, args)
+        loss = log_loss(y_test, probas, labels=classes)
+        print(f"Epoch {state['epoch'] + 1}: test log loss {loss:.6f}")
+        if loss > state["best_loss"] - args.tol:
+            state["n_no_change"] += 1
+            if state["n_no_change"] >= args.n_iter_no_change:
+                print(f"Converged after {state['epoch'] + 1} epochs")
+                state["converged"] = True
+        else:
+            state["n_no_change"] = 0
+        state["best_loss"] = min(loss, state["best_loss"])
+        state["epoch"] += 1
+        state["offset"] = 0
+        save_checkpoint(state, args)
+    return model, test_specs
+
+
 def evaluate(model, X_test, y_test, args):
     print("Validating LR model")
     predictions = model.predict(X_test)
+    return classification_metrics(y_test, predictions)
+
+
+def classification_metrics(y_test, predictions):
     print("Creating classification evaluation report")
     report_dict = classification_report(y_test, predictions, output_dict=True)
     report_dict["accuracy"] = accuracy_score(y_test, predictions)
@@ -60,6 +946,42 @@ def parse_arg():
     parser.add_argument("--test", type=str, default="/opt/ml/input/data/test")
     parser.add_argument("--model-dir", type=str, default="/opt/ml/model")
     parser.add_argument("--inspect", type=bool, default=False)
+    parser.add_argument(
+        "--feature-format", type=str, default="csv", choices=list(feature_extensions)
+    )
+    parser.add_argument(
+        "--dtype", type=str, default="float64", choices=["float32", "float64"]
+    )
+    parser.add_argument("--mmap", action="store_true")
+    parser.add_argument(
+        "--hosts", type=json.loads, default=os.environ.get("SM_HOSTS", "[]")
+    )
+    parser.add_argument(
+        "--current-host", type=str, default=os.environ.get("SM_CURRENT_HOST")
+    )
+    parser.add_argument("--averaging-host", type=str, default=None)
+    parser.add_argument("--averaging-port", type=int, default=29500)
+    parser.add_argument("--averaging-rounds", type=int, default=1)
+    parser.add_argument("--averaging-token", type=str, default=None)
+    parser.add_argument("--local-max-iter", type=int, default=100)
+    parser.add_argument("--warm-start-model", type=str, default=None)
+    parser.add_argument("--compare-cold-start", action="store_true")
+    parser.add_argument(
+        "--estimators", type=str, nargs="+", choices=list(candidate_estimators)
+    )
+    parser.add_argument("--search", action="store_true")
+    parser.add_argument("--search-jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--halving-factor", type=int, default=3)
+    parser.add_argument("--chunksize", type=int, default=None)
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--tol", type=float, default=1e-4)
+    parser.add_argument("--n-iter-no-change", type=int, default=1)
+    parser.add_argument(
+        "--checkpoint-dir",
+        type=str,
+        default="/opt/ml/checkpoints" if os.path.isdir("/opt/ml/checkpoints") else None,
+    )
+    parser.add_argument("--checkpoint-every", type=int, default=1)
     args, _ = parser.parse_known_args()
     print(f"Received arguments {args}")
     return args
@@ -70,9 +992,84 @@ def main(args):
     To run locally for debug/development purposes on *NIX system:
 
     python train.py --train /tmp/train --test /tmp/test --model-dir /tmp/model
+
+    Features written with --dtype float32 can be read as float32 with the same
+    option, halving their memory. With --mmap, npy features are memory mapped
+    and fitted without a copy (float64 for the lbfgs solver), and feather
+    features are copied once from Arrow into an array.
+
+    With --warm-start-model, the solver starts from the coefficients of a
+    previous model.tar.gz (or model.joblib), unless its features differ.
+    Iterations and wall time to convergence are logged, and with
+    --compare-cold-start also those of a cold start for reference:
+
+    python train.py --train /tmp/train --test /tmp/test --model-dir /tmp/model \\
+        --warm-start-model /tmp/previous/model.tar.gz
+
+    On several SageMaker hosts (SM_HOSTS, or --hosts and --current-host),
+    each host trains on its own train channel shard, such as the part-*
+    files it receives with 'ShardedByS3Key', and the shard models are
+    averaged, weighted by rows, over --averaging-rounds rounds. The first
+    host collects them on --averaging-port, then evaluates and saves the
+    averaged model. The hosts authenticate each other with a secret derived
+    from the training job name and --averaging-token, a random hyperparameter
+    of the job, and exchange only raw float64 coefficients. Locally,
+    processes stand in for hosts:
+
+    python train.py --train /tmp/train-1 --test /tmp/test --model-dir /tmp/model \\
+        --hosts '["algo-1", "algo-2"]' --current-host algo-1 \\
+        --averaging-host localhost --averaging-token "$TOKEN" &
+    python train.py --train /tmp/train-2 --test /tmp/test --model-dir /tmp/model \\
+        --hosts '["algo-1", "algo-2"]' --current-host algo-2 \\
+        --averaging-host localhost --averaging-token "$TOKEN"
+
+    With --estimators, each of the listed `candidate_estimators` is fitted
+    on its own process from features read once, saved as model-<name>.joblib
+    and ranked in leaderboard.json by the ROC AUC on training rows held out
+    for validation, and the best is saved as model.joblib:
+
+    python train.py --train /tmp/train --test /tmp/test --model-dir /tmp/model \\
+        --estimators lr sgd hgb
+
+    With --search, the LogisticRegression hyperparameters are picked from
+    `search_grid` by successive halving with --halving-factor, on
+    --search-jobs processes, and the search is reported in
+    search_report.json next to the model.
+
+    With --chunksize, csv or npy features are streamed from disk in chunks of
+    that many rows into an SGD logistic regression for up to --epochs epochs,
+    stopping early once the test log loss improves by less than --tol for
+    --n-iter-no-change epochs. The training state is checkpointed every
+    --checkpoint-every chunks to --checkpoint-dir, by default
+    /opt/ml/checkpoints if SageMaker created it for a checkpoint S3 URI, and
+    a restarted job, e.g. after a spot interruption, resumes from there. The
+    checkpoint is removed once the model is saved:
+
+    python train.py --train /tmp/train --test /tmp/test --model-dir /tmp/model \\
+        --chunksize 100000 --epochs 10
     """
+    if args.chunksize:
+        model, test_specs = train_chunks(args)
+        y_test, predictions, _ = predict_chunks(model, test_specs, args)
+        report_dict = classification_metrics(y_test, predictions)
+        print(report_dict)
+        save_model(model, args)
+        remove_checkpoint(args)
+        return
     X_train, y_train, X_test, y_test = read_processed_data(args)
-    model = train(X_train, y_train, args)
+    if args.estimators:
+        fitted = train_estimators(X_train, y_train, args)
+        print(save_leaderboard(fitted, X_test, y_test, args))
+        return
+    if len(args.hosts) > 1:
+        model = train_data_parallel(X_train, y_train, args)
+        if args.current_host != sorted(args.hosts)[0]:
+            return
+    elif args.search:
+        model, search_report = search(X_train, y_train, args)
+        save_search_report(search_report, args)
+    else:
+        model = train(X_train, y_train, args)
     report_dict = evaluate(model, X_test, y_test, args)
     print(report_dict)
     save_model(model, args)
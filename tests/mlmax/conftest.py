@@ -28,6 +28,24 @@ def args_train():
     parser.add_argument(
         "--data-input", type=str, default="input/census-income-sample.csv"
     )
+    parser.add_argument("--chunksize", type=int, default=None)
+    parser.add_argument("--csv-engine", type=str, default="c")
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument("--backend", type=str, default="pandas")
+    parser.add_argument("--split-method", type=str, default="random")
+    parser.add_argument("--feature-format", type=str, default="csv")
+    parser.add_argument("--sparse", action="store_true")
+    parser.add_argument("--compiled", action="store_true")
+    parser.add_argument("--hash-cols", type=str, nargs="*", default=[])
+    parser.add_argument("--hash-features", type=int, default=1024)
+    parser.add_argument("--output-shards", type=int, default=1)
+    parser.add_argument("--write-jobs", type=int, default=1)
+    parser.add_argument("--compression", type=str, default=None)
+    parser.add_argument("--refit-from", type=str, default=None)
+    parser.add_argument("--fit-sample", type=int, default=None)
+    parser.add_argument("--feature-cache", type=str, default=None)
+    parser.add_argument("--data-quality-rules", type=str, default=None)
+    parser.add_argument("--dtype", type=str, default="float64")
     args, _ = parser.parse_known_args()
     os.makedirs(os.path.join(args.data_dir, "model"), exist_ok=True)
     os.makedirs(os.path.join(args.data_dir, "train"), exist_ok=True)
@@ -44,6 +62,24 @@ def args_infer():
     parser.add_argument(
         "--data-input", type=str, default="input/census-income-sample.csv"
     )
+    parser.add_argument("--chunksize", type=int, default=None)
+    parser.add_argument("--csv-engine", type=str, default="c")
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument("--backend", type=str, default="pandas")
+    parser.add_argument("--split-method", type=str, default="random")
+    parser.add_argument("--feature-format", type=str, default="csv")
+    parser.add_argument("--sparse", action="store_true")
+    parser.add_argument("--compiled", action="store_true")
+    parser.add_argument("--hash-cols", type=str, nargs="*", default=[])
+    parser.add_argument("--hash-features", type=int, default=1024)
+    parser.add_argument("--output-shards", type=int, default=1)
+    parser.add_argument("--write-jobs", type=int, default=1)
+    parser.add_argument("--compression", type=str, default=None)
+    parser.add_argument("--refit-from", type=str, default=None)
+    parser.add_argument("--fit-sample", type=int, default=None)
+    parser.add_argument("--feature-cache", type=str, default=None)
+    parser.add_argument("--data-quality-rules", type=str, default=None)
+    parser.add_argument("--dtype", type=str, default="float64")
     args, _ = parser.parse_known_args()
     os.makedirs(os.path.join(args.data_dir, "test"), exist_ok=True)
     return args
@@ -3,10 +3,13 @@ import pandas as pd
 import datatest as dt
 import argparse
 import os
+import shutil
 import tarfile
+import numpy as np
 
 from mlmax.evaluation import (
     read_features,
+    read_shards,
     load_model,
     evaluate,
     parse_arg,
@@ -23,6 +26,9 @@ def args():
     parser.add_argument("--labels-input", type=str, default="test/test_labels.csv")
     parser.add_argument("--model-input", type=str, default="model/model.tar.gz")
     parser.add_argument("--eval-output", type=str, default="evaluation/evaluation.json")
+    parser.add_argument("--feature-format", type=str, default="csv")
+    parser.add_argument("--dtype", type=str, default="float64")
+    parser.add_argument("--baseline-eval", type=str, default=None)
     args, _ = parser.parse_known_args()
     os.makedirs(os.path.join(args.data_dir, "evaluation"), exist_ok=True)
     print(f"Received arguments {args}")
@@ -55,6 +61,13 @@ def test_read_features(args):
     assert X_test.shape[0] == y_test.shape[0]
 
 
+def test_read_shards_no_data(tmpdir):
+    """A directory with only empty shards fails clearly."""
+    tmpdir.join("part-00000.csv").write("")
+    with pytest.raises(ValueError, match="No non-empty"):
+        read_shards(str(tmpdir), "test")
+
+
 @dt.working_directory(__file__)
 def test_load_model(tar_model, args):
     model = load_model(args)
@@ -71,6 +84,28 @@ def test_evaluate(load_joblib_model, args):
     assert isinstance(report_dict["macro avg"]["f1-score"], float)
 
 
+@dt.working_directory(__file__)
+def test_evaluate_baseline_delta(load_joblib_model, args):
+    """
+    A float32 evaluation reports its metric deltas from a float64 baseline.
+    """
+    X_test, y_test = read_features(args)
+    baseline = evaluate(load_joblib_model, X_test, y_test, args)
+    baseline_path = os.path.join(args.data_dir, "evaluation/baseline.json")
+    shutil.copy(os.path.join(args.data_dir, args.eval_output), baseline_path)
+
+    args.dtype = "float32"
+    args.baseline_eval = "evaluation/baseline.json"
+    X_test, y_test = read_features(args)
+    assert (X_test.dtypes == np.float32).all()
+    report_dict = evaluate(load_joblib_model, X_test, y_test, args)
+    delta = report_dict["baseline_delta"]
+    assert delta["dtype"] == "float64"
+    assert delta["accuracy"] == report_dict["accuracy"] - baseline["accuracy"]
+    assert abs(delta["roc_auc"]) < 0.01
+    assert abs(delta["macro_f1"]) < 0.01
+
+
 @dt.working_directory(__file__)
 def test_main(tar_model, args):
     main(args)
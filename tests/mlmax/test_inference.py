@@ -1,10 +1,14 @@
 import argparse
+import os
+from collections import OrderedDict
 import pytest
 import pandas as pd
 import datatest as dt
 from sklearn.linear_model import LogisticRegression
 
+import mlmax.inference
 from mlmax.inference import (
+    load_artifact,
     load_model,
     load_test_input,
     write_data,
@@ -20,6 +24,12 @@ def args():
     parser.add_argument("--data-dir",
                         type=str,
                         default="opt/ml/processing")
+    parser.add_argument("--feature-format",
+                        type=str,
+                        default="csv")
+    parser.add_argument("--dtype",
+                        type=str,
+                        default="float64")
     args, _ = parser.parse_known_args()
     print(f"Received arguments {args}")
     return args
@@ -35,6 +45,44 @@ def test_load_model(args):
     assert isinstance(model, LogisticRegression)
 
 
+@dt.working_directory(__file__)
+def test_load_artifact_cache(args, tmpdir, monkeypatch):
+    """
+    A tarball is extracted once per digest and the loaded model is memoized.
+    """
+    monkeypatch.setattr(mlmax.inference, "artifact_cache_dir", str(tmpdir))
+    monkeypatch.setattr(mlmax.inference, "_artifact_cache", OrderedDict())
+    model_path = os.path.join(args.data_dir, "model/model.tar.gz")
+    model = load_artifact(model_path)
+    assert load_artifact(model_path) is model
+    assert len(tmpdir.listdir()) == 1
+    assert tmpdir.listdir()[0].join("model.joblib").check()
+
+    mmap_model = load_artifact(model_path, mmap_mode="r")
+    assert mmap_model is not model
+    assert isinstance(mmap_model, LogisticRegression)
+    assert len(tmpdir.listdir()) == 1
+
+
+@dt.working_directory(__file__)
+def test_load_artifact_shared_cache(args, tmpdir, monkeypatch):
+    """
+    A cache directory other users can write to is refused, and a missing
+    one is created private to the current user.
+    """
+    cache_dir = tmpdir.join("cache")
+    monkeypatch.setattr(mlmax.inference, "artifact_cache_dir", str(cache_dir))
+    monkeypatch.setattr(mlmax.inference, "_artifact_cache", OrderedDict())
+    model_path = os.path.join(args.data_dir, "model/model.tar.gz")
+    load_artifact(model_path)
+    assert cache_dir.stat().mode & 0o777 == 0o700
+
+    cache_dir.chmod(0o777)
+    monkeypatch.setattr(mlmax.inference, "_artifact_cache", OrderedDict())
+    with pytest.raises(ValueError, match="writable by no one else"):
+        load_artifact(model_path)
+
+
 @dt.working_directory(__file__)
 def test_load_test_input(args):
     """
@@ -1,5 +1,6 @@
 import argparse
 import json
+import os
 
 import numpy as np
 import pandas as pd
@@ -13,6 +14,7 @@ from mlmax.monitoring import (
     get_cols_types,
     get_dataframe_stats,
     get_num_distribution,
+    read_data,
     write_dataframe,
     write_json,
 )
@@ -31,6 +33,7 @@ def args():
         "--transformer_input", type=str, default="proc_model/proc_model.tar.gz"
     )
     parser.add_argument("--model_input", type=str, default="model/model.tar.gz")
+    parser.add_argument("--backend", type=str, default="pandas")
     args, _ = parser.parse_known_args()
     print(f"Received arguments {args}")
     return args
@@ -76,6 +79,17 @@ def test_get_cols_types(dummy_df):
     assert num_cols.tolist() == ["f1"]
 
 
+def test_get_cols_types_category(dummy_df):
+    cat_cols, num_cols = get_cols_types(dummy_df.astype({"f2": "category"}))
+    assert cat_cols.tolist() == ["f2"]
+    assert num_cols.tolist() == ["f1"]
+
+
+def test_get_cat_counts_category(dummy_df):
+    data = dummy_df["f2"].astype(pd.CategoricalDtype(["a", "b", "c", "d", "e"]))
+    assert get_cat_counts(data) == get_cat_counts(dummy_df["f2"])
+
+
 def test_get_dataframe_stats(dummy_df):
     stats_dict = get_dataframe_stats(dummy_df)
     expected = {
@@ -213,6 +227,18 @@ def test_train_data_profiling(dummy_df, args):
     assert result == expected
 
 
+def test_read_data_polars():
+    """
+    The Polars backend reads the census sample identically.
+    """
+    pytest.importorskip("polars")
+    input_data_path = os.path.join(
+        os.path.dirname(__file__), "opt/ml/processing/input/census-income-sample.csv"
+    )
+    df = read_data(input_data_path)
+    pd.testing.assert_frame_equal(read_data(input_data_path, backend="polars"), df)
+
+
 def test_calculate_psi(psi_df):
     result = calculate_psi(psi_df["f1"], psi_df["f2"], buckettype="bins", bins=10)
     assert round(result, 5) == 1.38017
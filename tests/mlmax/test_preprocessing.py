@@ -1,13 +1,44 @@
+import argparse
+import gzip
+import io
+import json
+import os
+import shutil
+import tarfile
 import pytest
 import pandas as pd
 import datatest as dt
+import numpy as np
+from scipy import sparse
 
 from mlmax.preprocessing import (
+    binned_cols,
+    n_bins,
+    scaled_cols,
+    categorical_cols,
+    byte_ranges,
     read_data,
+    read_data_chunks,
+    read_csv,
+    summarize_data,
+    merge_summaries,
+    check_data_quality,
+    data_quality_rules,
     transform,
     write_data,
     split_data,
+    hash_split,
     fit,
+    fit_from_stats,
+    compile_preprocess,
+    transform_compiled,
+    init_fit_stats,
+    update_fit_stats,
+    update_sketch,
+    init_sample,
+    load_preprocess,
+    update_sample,
+    sketch_quantiles,
     parse_arg,
     main
 )
@@ -38,6 +69,34 @@ def test_read_data(input_data_path):
     dt.validate(df.columns, required_names)
     # check the label values
     dt.validate(df["income"].values, required_labels)
+    # check the compact dtypes
+    assert df["education"].dtype.name == "category"
+    assert df["age"].dtype.name == "int32"
+    assert df["income"].dtype.name == "int8"
+
+
+@pytest.mark.parametrize("engine", ["c", "python"])
+@dt.working_directory(__file__)
+def test_read_data_numeric_nulls(input_data_path, tmpdir, engine):
+    """
+    A row with an empty numeric cell is dropped, and the null is counted.
+    """
+    expected = read_data(input_data_path)
+    raw = pd.read_csv(input_data_path)
+    # A row without duplicates, so that no other row replaces it
+    row = raw.index[~raw[expected.columns].duplicated(keep=False)][0]
+    raw.loc[row, "capital gains"] = np.nan
+    path = str(tmpdir.join("input.csv"))
+    raw.to_csv(path, index=False)
+    df = read_data(path, engine)
+    pd.testing.assert_frame_equal(df, expected.drop(index=row))
+    assert df["capital gains"].dtype.name == "int32"
+
+    summary = summarize_data(read_csv(path))
+    assert summary["nulls"]["capital gains"] == 1
+    rules = dict(data_quality_rules, max_null_ratio={"capital gains": 0.0})
+    with pytest.raises(ValueError, match="capital gains: null ratio"):
+        check_data_quality(summary, rules)
 
 
 @dt.working_directory(__file__)
@@ -61,6 +120,716 @@ def test_infer_preprocessing(input_data_path, args_infer):
     # To do: add assertion
 
 
+@dt.working_directory(__file__)
+def test_byte_ranges(input_data_path):
+    header, ranges = byte_ranges(input_data_path, 4)
+    assert len(ranges) == 4
+    with open(input_data_path, "rb") as f:
+        content = f.read()
+    assert content.startswith(header)
+    assert ranges[0][0] == len(header)
+    assert ranges[-1][1] == len(content)
+    for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+        assert end == start
+        assert content[end - 1 : end] == b"\n"
+
+
+@dt.working_directory(__file__)
+def test_read_data_parallel(input_data_path, tmpdir):
+    """
+    Parallel and multi-file reads match the single-process read.
+    """
+    expected = read_data(input_data_path).reset_index(drop=True)
+    pd.testing.assert_frame_equal(read_data(input_data_path, n_jobs=3), expected)
+
+    with open(input_data_path) as f:
+        lines = f.readlines()
+    for i, part in enumerate([lines[1:200], lines[200:]]):
+        tmpdir.join(f"part-{i}.csv").write("".join([lines[0]] + part))
+    df = read_data(str(tmpdir.join("part-*.csv")))
+    pd.testing.assert_frame_equal(df, expected)
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+@dt.working_directory(__file__)
+def test_read_data_polars(input_data_path, n_jobs):
+    pytest.importorskip("polars")
+    expected = read_data(input_data_path, n_jobs=n_jobs)
+    df = read_data(input_data_path, n_jobs=n_jobs, backend="polars")
+    pd.testing.assert_frame_equal(df, expected)
+
+
+@dt.working_directory(__file__)
+def test_check_data_quality(input_data_path):
+    """
+    The gate passes the sample with the default rules, and reports every
+    violation of stricter ones at once.
+    """
+    raw = read_csv(input_data_path)
+    summary = summarize_data(raw)
+    halves = [summarize_data(raw.iloc[:200]), summarize_data(raw.iloc[200:])]
+    assert merge_summaries(*halves) == summary
+    check_data_quality(summary, data_quality_rules)
+
+    rules = {
+        "rows": [1000, None],
+        "ranges": {"age": [18, None]},
+        "categories": {"class of worker": [" Private"]},
+        "max_null_ratio": {"age": 0.0},
+    }
+    with pytest.raises(ValueError, match="3 problems") as error:
+        check_data_quality(summary, rules)
+    for col in ["rows", "age", "class of worker"]:
+        assert f"{col}: " in str(error.value)
+    with pytest.raises(ValueError, match="2 problems"):
+        check_data_quality(summary, rules, final=False)
+
+
+@pytest.mark.parametrize("chunksize", [None, 100])
+@dt.working_directory(__file__)
+def test_data_quality_gate(args_train_tmpdir, chunksize):
+    """
+    A failing gate stops the job before anything is fitted or written.
+    """
+    args = args_train_tmpdir
+    args.chunksize = chunksize
+    args.data_quality_rules = "rules.json"
+    with open(os.path.join(args.data_dir, "rules.json"), "w") as f:
+        json.dump({"rows": [10 ** 6, None]}, f)
+    with pytest.raises(ValueError, match="rows: 500"):
+        main(args)
+    for subdir in ["model", "train", "test"]:
+        assert os.listdir(os.path.join(args.data_dir, subdir)) == []
+
+
+@dt.working_directory(__file__)
+def test_data_quality_gate_infer_chunked(args_train_tmpdir):
+    """
+    A chunked infer run that fails the final checks leaves no outputs.
+    """
+    args = args_train_tmpdir
+    args.chunksize = 100
+    main(args)
+    for name in os.listdir(os.path.join(args.data_dir, "test")):
+        os.remove(os.path.join(args.data_dir, "test", name))
+    args.mode = "infer"
+    args.data_quality_rules = "rules.json"
+    with open(os.path.join(args.data_dir, "rules.json"), "w") as f:
+        json.dump({"rows": [10 ** 6, None]}, f)
+    with pytest.raises(ValueError, match="rows: 500"):
+        main(args)
+    assert os.listdir(os.path.join(args.data_dir, "test")) == []
+
+    args.data_quality_rules = None
+    assert main(args) > 0
+    assert sorted(os.listdir(os.path.join(args.data_dir, "test"))) == [
+        "test_features.csv",
+        "test_labels.csv",
+    ]
+
+
+@dt.working_directory(__file__)
+def test_read_data_chunks(input_data_path):
+    chunks = list(read_data_chunks(input_data_path, 100))
+    assert len(chunks) == 5
+    for chunk in chunks:
+        dt.validate(chunk["income"].values, {0, 1})
+    # duplicates are dropped across chunks
+    df = pd.concat(chunks)
+    assert len(df) == len(read_data(input_data_path))
+    assert not df.duplicated().any()
+    # the first occurrence of each row is kept
+    assert df.index.equals(read_data(input_data_path).index)
+
+
+@dt.working_directory(__file__)
+def test_split_data_single_row(input_data_path, args_train):
+    df = read_data(input_data_path).head(1)
+    X_train, X_test, y_train, y_test = split_data(df, args_train)
+    assert (len(X_train), len(X_test), len(y_train), len(y_test)) == (1, 0, 1, 0)
+
+
+@dt.working_directory(__file__)
+def test_hash_split(input_data_path):
+    df = read_data(input_data_path)
+    X_train, X_test, y_train, y_test = hash_split(df, 0.3)
+    assert len(X_train) + len(X_test) == len(df)
+    assert len(X_train) == len(y_train)
+    assert 0.2 < len(X_test) / len(df) < 0.4
+    assert "income" not in X_train.columns
+
+    # rows are routed independently of how the data is chunked
+    chunked = [hash_split(df.iloc[i : i + 50], 0.3)[1] for i in range(0, len(df), 50)]
+    pd.testing.assert_frame_equal(pd.concat(chunked), X_test)
+
+
+@dt.working_directory(__file__)
+def test_infer_preprocessing_chunked(input_data_path, args_infer):
+    """
+    Streaming a single chunk must give the same features as the in-memory path.
+    """
+    features_path = os.path.join(args_infer.data_dir, "test/test_features.csv")
+    test_features = main(args_infer)
+    expected = pd.read_csv(features_path, header=None)
+
+    args = argparse.Namespace(**vars(args_infer))
+    args.chunksize = 1000
+    n_rows = main(args)
+    assert n_rows == test_features.shape[0]
+    pd.testing.assert_frame_equal(pd.read_csv(features_path, header=None), expected)
+
+    args.chunksize = 100
+    n_rows = main(args)
+    assert pd.read_csv(features_path, header=None).shape[0] == n_rows
+
+
+@dt.working_directory(__file__)
+def test_infer_preprocessing_empty_chunk(input_data_path, args_infer, tmpdir):
+    """
+    A chunk that cleaning empties is skipped rather than transformed.
+    """
+    for subdir in ["input", "model", "test"]:
+        tmpdir.mkdir(subdir)
+    shutil.copy(
+        os.path.join(args_infer.data_dir, "model/proc_model.tar.gz"),
+        str(tmpdir.join("model")),
+    )
+    raw = pd.read_csv(input_data_path)
+    blanked = raw.head(100).assign(education=np.nan)
+    pd.concat([blanked, raw]).to_csv(
+        str(tmpdir.join(args_infer.data_input)), index=False
+    )
+    args = argparse.Namespace(**vars(args_infer))
+    args.data_dir = str(tmpdir)
+    args.chunksize = 100
+    n_rows = main(args)
+    features_path = os.path.join(args.data_dir, "test/test_features.csv")
+    assert n_rows == len(read_data(input_data_path))
+    assert pd.read_csv(features_path, header=None).shape[0] == n_rows
+
+
+def test_sketch_quantiles():
+    values = np.random.RandomState(0).randint(0, 100, size=1000)
+    quantiles = np.linspace(0, 1, 11)
+    expected = np.percentile(values, quantiles * 100)
+    sketch = None
+    for chunk in np.array_split(values, 7):
+        sketch = update_sketch(sketch, chunk)
+    np.testing.assert_allclose(sketch_quantiles(sketch, quantiles), expected)
+
+    # A compressed sketch is approximate
+    compressed = update_sketch(None, values, max_size=20)
+    assert len(compressed) == 20
+    np.testing.assert_allclose(
+        sketch_quantiles(compressed, quantiles)[1:-1], expected[1:-1], atol=5
+    )
+
+
+@dt.working_directory(__file__)
+def test_fit_from_stats(input_data_path, args_train):
+    """
+    A model fitted from streamed chunks transforms like a model fitted at once.
+    """
+    df = read_data(input_data_path)
+    X_train, _, _, _ = split_data(df, args_train)
+    expected = fit(X_train, args_train).transform(X_train)
+
+    stats = init_fit_stats()
+    for start in range(0, len(X_train), 50):
+        update_fit_stats(stats, X_train.iloc[start : start + 50])
+    preprocess = fit_from_stats(stats, args_train)
+    np.testing.assert_allclose(preprocess.transform(X_train), expected)
+
+
+@dt.working_directory(__file__)
+def test_fit_from_stats_narrow_bins(input_data_path, args_train, monkeypatch):
+    """
+    With a scikit-learn that drops narrow bins, the bins of repeated edges
+    are dropped and the one-hot encoder of the bins is fitted for the rest.
+    """
+    monkeypatch.setattr("mlmax.preprocessing.drops_narrow_bins", True)
+    df = read_data(input_data_path)
+    X_train, _, _, _ = split_data(df, args_train)
+    stats = update_fit_stats(init_fit_stats(), X_train)
+    preprocess = fit_from_stats(stats, args_train)
+    binner = preprocess.transformers_[0][1]
+    edges = binner.bin_edges_[1]
+    assert len(np.unique(edges)) == len(edges) < n_bins + 1
+    assert list(binner.n_bins_) == [len(e) - 1 for e in binner.bin_edges_]
+    binned = binner.transform(X_train[binned_cols])
+    assert binned.shape == (len(X_train), sum(binner.n_bins_))
+    assert (np.asarray(binned).sum(axis=1) == len(binned_cols)).all()
+
+
+@dt.working_directory(__file__)
+def test_transform_compiled(input_data_path, args_train):
+    """
+    The compiled numpy transform reproduces the sklearn transform.
+    """
+    df = read_data(input_data_path)
+    X_train, X_test, _, _ = split_data(df, args_train)
+    preprocess = fit(X_train, args_train)
+    compiled = compile_preprocess(preprocess)
+    np.testing.assert_allclose(
+        transform_compiled(compiled, X_train), preprocess.transform(X_train)
+    )
+    row = X_train.iloc[:1]
+    single = {col: row[col].values for col in row.columns}
+    np.testing.assert_allclose(
+        transform_compiled(compiled, single), preprocess.transform(row)
+    )
+    unknown = X_train.iloc[:1].astype(object)
+    unknown["education"] = " Unknown"
+    with pytest.raises(ValueError):
+        transform_compiled(compiled, unknown)
+
+
+@dt.working_directory(__file__)
+def test_hashed_preprocessing(input_data_path, args_train):
+    """
+    Hashed categorical columns have a fixed width, accept unseen categories
+    and are reproduced by the compiled transform.
+    """
+    args = argparse.Namespace(**vars(args_train))
+    args.sparse = True
+    args.hash_cols = ["education", "major industry code"]
+    args.hash_features = 64
+    df = read_data(input_data_path)
+    X_train, X_test, _, _ = split_data(df, args)
+    preprocess = fit(X_train, args)
+    features = preprocess.transform(X_train)
+    assert sparse.issparse(features)
+    n_onehot = X_train["class of worker"].nunique()
+    assert features.shape[1] == 2 * 10 + 3 + n_onehot + 64
+    np.testing.assert_array_equal(features[:, -64:].sum(axis=1), 2)
+
+    unknown = X_train.iloc[:5].astype(object)
+    unknown["education"] = " Unknown"
+    assert preprocess.transform(unknown).shape == (5, features.shape[1])
+
+    compiled = compile_preprocess(preprocess)
+    np.testing.assert_allclose(
+        transform_compiled(compiled, unknown), preprocess.transform(unknown).toarray()
+    )
+    np.testing.assert_allclose(
+        transform_compiled(compiled, X_train), features.toarray()
+    )
+
+
+@pytest.fixture()
+@dt.working_directory(__file__)
+def args_train_tmpdir(input_data_path, args_train, tmpdir):
+    """
+    Train mode arguments writing to a temporary directory, so that the
+    outputs do not replace the fixtures used by the other test modules.
+    """
+    for subdir in ["input", "model", "train", "test"]:
+        tmpdir.mkdir(subdir)
+    shutil.copy(input_data_path, str(tmpdir.join(args_train.data_input)))
+    args = argparse.Namespace(**vars(args_train))
+    args.data_dir = str(tmpdir)
+    return args
+
+
+@dt.working_directory(__file__)
+def test_train_preprocessing_chunked(args_train_tmpdir):
+    args = args_train_tmpdir
+    args.chunksize = 100
+    n_train, n_test = main(args)
+    train_path = os.path.join(args.data_dir, "train/train_features.csv")
+    test_path = os.path.join(args.data_dir, "test/test_features.csv")
+    train_features = pd.read_csv(train_path, header=None)
+    test_features = pd.read_csv(test_path, header=None)
+    assert train_features.shape[0] == n_train
+    assert test_features.shape[0] == n_test
+    assert train_features.shape[1] == test_features.shape[1]
+
+
+@pytest.mark.parametrize("mode", ["train", "infer"])
+@dt.working_directory(__file__)
+def test_preprocessing_repeated_input(args_train_tmpdir, mode):
+    """
+    A chunk made only of rows seen in earlier chunks is dropped as a whole.
+    """
+    args = args_train_tmpdir
+    args.chunksize = 500
+    input_path = os.path.join(args.data_dir, args.data_input)
+    n_rows = len(read_data(input_path))
+    raw = pd.read_csv(input_path)
+    pd.concat([raw, raw]).to_csv(input_path, index=False)
+    if mode == "infer":
+        main(args)
+        args.mode = "infer"
+        assert main(args) == n_rows
+    else:
+        assert sum(main(args)) == n_rows
+
+
+@pytest.mark.parametrize("chunksize", [499, 249])
+@dt.working_directory(__file__)
+def test_train_preprocessing_uneven_chunks(args_train_tmpdir, chunksize):
+    """
+    A chunk size that does not divide the input leaves a small last chunk,
+    which is too small to split and goes to the training set.
+    """
+    args = args_train_tmpdir
+    args.chunksize = chunksize
+    n_train, n_test = main(args)
+    assert n_train + n_test == len(read_data(os.path.join(args.data_dir, args.data_input)))
+    for split, n_rows in [("train", n_train), ("test", n_test)]:
+        path = os.path.join(args.data_dir, f"{split}/{split}_features.csv")
+        assert pd.read_csv(path, header=None).shape[0] == n_rows
+
+
+@pytest.mark.parametrize("chunksize", [100, 499])
+@dt.working_directory(__file__)
+def test_train_preprocessing_hash_split(args_train_tmpdir, chunksize):
+    """
+    With the hash split, chunked and in-memory runs write the same rows, also
+    when a small chunk sends all its rows to one side.
+    """
+    args = args_train_tmpdir
+    args.split_method = "hash"
+    args.chunksize = chunksize
+    n_train, n_test = main(args)
+    df = read_data(os.path.join(args.data_dir, args.data_input))
+    X_train, X_test, _, _ = split_data(df, args)
+    assert n_train == len(X_train)
+    assert n_test == len(X_test)
+
+
+@pytest.mark.parametrize("chunksize", [None, 100])
+@dt.working_directory(__file__)
+def test_sharded_preprocessing(args_train_tmpdir, chunksize):
+    """
+    Sharded outputs are balanced, match the manifest and read back as a split.
+    """
+    from mlmax.train import read_xy
+
+    args = args_train_tmpdir
+    args.output_shards = 3
+    args.chunksize = chunksize
+    main(args)
+
+    train_dir = os.path.join(args.data_dir, "train")
+    with open(os.path.join(train_dir, "train_manifest.json")) as f:
+        manifest = json.load(f)
+    rows = [shard["rows"] for shard in manifest["shards"]]
+    assert len(rows) == 3
+    assert max(rows) - min(rows) <= 1
+    for shard in manifest["shards"]:
+        part = pd.read_csv(os.path.join(train_dir, shard["file"]), header=None)
+        assert len(part) == shard["rows"]
+        assert len(shard["sha256"]) == 64
+
+    X_train, y_train = read_xy(train_dir, "train")
+    assert X_train.shape[0] == sum(rows)
+    assert y_train.shape == (sum(rows), 1)
+    dt.validate(y_train.iloc[:, 0], {0, 1})
+
+
+@pytest.mark.parametrize("chunksize", [None, 100])
+@dt.working_directory(__file__)
+def test_sharded_infer_after_train(args_train_tmpdir, chunksize):
+    """
+    Sharded infer outputs replace the single-file outputs of an earlier
+    train run in the same directory, and are read by inference.py without
+    their label column.
+    """
+    from mlmax.inference import load_test_input
+
+    args = args_train_tmpdir
+    main(args)
+    n_features = pd.read_csv(
+        os.path.join(args.data_dir, "train/train_features.csv"), header=None
+    ).shape[1]
+    args.mode = "infer"
+    args.output_shards = 2
+    args.chunksize = chunksize
+    main(args)
+
+    test_dir = os.path.join(args.data_dir, "test")
+    assert sorted(os.listdir(test_dir)) == [
+        "part-00000.csv",
+        "part-00001.csv",
+        "test_manifest.json",
+    ]
+    with open(os.path.join(test_dir, "test_manifest.json")) as f:
+        manifest = json.load(f)
+    assert manifest["labels"]
+    shutil.copytree(test_dir, os.path.join(args.data_dir, "batch", "input"))
+    X_test = load_test_input(os.path.join(args.data_dir, "batch"))
+    assert X_test.shape == (sum(s["rows"] for s in manifest["shards"]), n_features)
+
+
+@dt.working_directory(__file__)
+def test_sharded_outputs_stale(args_train_tmpdir):
+    """
+    Only the shards listed in the manifest are read, after checking their
+    checksums, and a split mixing shards with single files is refused.
+    """
+    from mlmax.train import read_xy
+
+    args = args_train_tmpdir
+    args.output_shards = 3
+    main(args)
+    args.output_shards = 2
+    main(args)
+    train_dir = os.path.join(args.data_dir, "train")
+    assert not os.path.exists(os.path.join(train_dir, "part-00002.csv"))
+    X_train, _ = read_xy(train_dir, "train")
+
+    stale_path = os.path.join(train_dir, "part-00002.csv")
+    pd.DataFrame(np.ones((5, X_train.shape[1] + 1))).to_csv(
+        stale_path, header=False, index=False
+    )
+    assert read_xy(train_dir, "train")[0].shape == X_train.shape
+
+    shutil.copy(stale_path, os.path.join(train_dir, "part-00001.csv"))
+    with pytest.raises(ValueError, match="Checksum"):
+        read_xy(train_dir, "train")
+
+    shutil.copy(stale_path, os.path.join(train_dir, "train_features.csv"))
+    with pytest.raises(ValueError, match="holds both"):
+        read_xy(train_dir, "train")
+
+
+@dt.working_directory(__file__)
+def test_sparse_preprocessing(args_train_tmpdir):
+    """
+    Sparse mode yields the same features as dense mode, stored as CSR .npz.
+    """
+    from mlmax.train import read_xy
+
+    args = args_train_tmpdir
+    dense_train_features, _ = main(args)
+    args.sparse = True
+    args.feature_format = "npz"
+    train_features, test_features = main(args)
+    assert sparse.isspmatrix_csr(train_features)
+    assert (train_features.toarray() == dense_train_features).all()
+
+    X_train, y_train = read_xy(os.path.join(args.data_dir, "train"), "train", "npz")
+    assert sparse.isspmatrix_csr(X_train)
+    assert (X_train != train_features).nnz == 0
+    assert isinstance(y_train, pd.DataFrame)
+    assert y_train.shape == (X_train.shape[0], 1)
+
+    args.hash_cols = ["education"]
+    args.chunksize = 100
+    args.feature_format = "csv"
+    n_train, _ = main(args)
+    X_train, _ = read_xy(os.path.join(args.data_dir, "train"), "train")
+    assert X_train.shape[0] == n_train
+    np.testing.assert_array_equal(X_train.iloc[:, -args.hash_features :].sum(1), 1)
+
+
+@dt.working_directory(__file__)
+def test_float32_preprocessing(args_train_tmpdir):
+    from mlmax.train import read_xy
+
+    args = args_train_tmpdir
+    expected, _ = main(args)
+    args.dtype = "float32"
+    train_features, _ = main(args)
+    assert train_features.dtype == np.float32
+    np.testing.assert_allclose(train_features, expected, rtol=1e-6)
+
+    X_train, _ = read_xy(os.path.join(args.data_dir, "train"), "train", dtype="float32")
+    assert (X_train.dtypes == np.float32).all()
+    np.testing.assert_allclose(X_train.values, expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize("with_stats", [True, False])
+@dt.working_directory(__file__)
+def test_refit_preprocessing(input_data_path, args_train_tmpdir, with_stats):
+    """
+    Refitting a model with new rows matches the moments and categories of a
+    fit on all the rows, also from a model archived without statistics.
+    """
+    args = args_train_tmpdir
+    df = read_data(input_data_path)
+    old, new = df.iloc[: len(df) // 2], df.iloc[len(df) // 2 :]
+    previous = fit(old, args)
+    previous_path = os.path.join(args.data_dir, "model/previous.tar.gz")
+    if with_stats:
+        shutil.copy(os.path.join(args.data_dir, "model/proc_model.tar.gz"), previous_path)
+    else:
+        with tarfile.open(previous_path, mode="w:gz") as archive:
+            archive.add("./model.joblib")
+
+    args.refit_from = "model/previous.tar.gz"
+    preprocess = fit(new, args)
+    discretizer, scaler, encoder = [t for _, t, _ in preprocess.transformers_]
+    np.testing.assert_allclose(scaler.mean_, df[scaled_cols].mean())
+    assert np.all(scaler.n_samples_seen_ == len(df))
+    for col, categories in zip(categorical_cols, encoder.categories_):
+        assert list(categories) == sorted(df[col].unique())
+    for col, edges in zip(binned_cols, discretizer.bin_edges_):
+        assert edges[0] == df[col].min() and edges[-1] == df[col].max()
+    assert preprocess.transform(df).shape[0] == len(df)
+    # The statistics are archived without leaving a file behind
+    assert not os.path.exists("fit_stats.joblib")
+
+
+@dt.working_directory(__file__)
+def test_feature_cache(args_train_tmpdir):
+    """
+    A re-run restores the cached outputs, until the input or options change.
+    """
+    pytest.importorskip("fsspec")
+    args = args_train_tmpdir
+    args.feature_cache = os.path.join(args.data_dir, "cache")
+    main(args)
+    train_path = os.path.join(args.data_dir, "train/train_features.csv")
+    expected = pd.read_csv(train_path, header=None)
+    os.remove(train_path)
+    assert main(args) is None
+    pd.testing.assert_frame_equal(pd.read_csv(train_path, header=None), expected)
+
+    args.mode = "infer"
+    assert main(args) is not None
+    assert main(args) is None
+    args.dtype = "float32"
+    assert main(args) is not None
+    assert len(os.listdir(args.feature_cache)) == 3
+
+
+@pytest.mark.parametrize(
+    "arg, value",
+    [
+        ("fit_sample", 100),
+        ("train_test_split_ratio", 0.2),
+        ("hash_cols", ["education"]),
+        ("compression", "gzip"),
+        ("data_quality_rules", "rules.json"),
+    ],
+)
+@dt.working_directory(__file__)
+def test_feature_cache_miss(args_train_tmpdir, arg, value):
+    """
+    Options that change the outputs, or the checks of the input, miss the
+    cache of a run without them.
+    """
+    pytest.importorskip("fsspec")
+    args = args_train_tmpdir
+    args.feature_cache = os.path.join(args.data_dir, "cache")
+    with open(os.path.join(args.data_dir, "rules.json"), "w") as f:
+        json.dump({"rows": [100, None]}, f)
+    main(args)
+    setattr(args, arg, value)
+    assert main(args) is not None
+    assert main(args) is None
+    assert len(os.listdir(args.feature_cache)) == 2
+
+
+@dt.working_directory(__file__)
+def test_update_sample(input_data_path):
+    """
+    The reservoir holds a sample of distinct rows of all the chunks.
+    """
+    df = read_data(input_data_path)
+    sample = init_sample()
+    for start in range(0, len(df), 100):
+        update_sample(sample, df.iloc[start : start + 100], 150)
+    assert sample["rows"] == len(df)
+    assert len(sample["frame"]) == 150
+    assert sample["frame"].index.is_unique
+    assert sample["frame"].index.isin(df.index).all()
+    counts = sample["category_counts"]["education"]
+    assert counts.sum() == len(df)
+
+
+@pytest.mark.parametrize("chunksize", [None, 100])
+@dt.working_directory(__file__)
+def test_fit_sample(args_train_tmpdir, chunksize):
+    """
+    A sample fit transforms all the rows, and reports error bounds that hold
+    the parameters of a full fit.
+    """
+    args = args_train_tmpdir
+    args.chunksize = chunksize
+    main(args)
+    expected = load_preprocess(args)
+    args.fit_sample = 200
+    main(args)
+
+    with open(os.path.join(args.data_dir, "model/fit_sample_report.json")) as f:
+        report = json.load(f)
+    assert report["sample_rows"] == 200
+    assert report["rows"] > 200
+    _, scaler, _ = [t for _, t, _ in expected.transformers_]
+    for col, mean, std in zip(scaled_cols, scaler.mean_, scaler.scale_):
+        low, high = report["scaler"][col]["mean_interval"]
+        assert low <= mean <= high
+        low, high = report["scaler"][col]["std_interval"]
+        assert low <= std <= high
+    for col in binned_cols:
+        edges = report["bin_edges"][col]["edge_intervals"]
+        assert len(edges) == 9
+        assert all(low <= high for low, high in edges)
+        assert 0 < report["bin_edges"][col]["max_quantile_error"] < 0.1
+    for col in categorical_cols:
+        assert 0 <= report["unseen_category_rate"][col] < 0.1
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "zstd"])
+@dt.working_directory(__file__)
+def test_write_outputs(args_train_tmpdir, compression, monkeypatch):
+    """
+    Concurrent, block compressed outputs hold the same rows as sequential
+    plain ones, and read back.
+    """
+    from mlmax import preprocessing
+    from mlmax.train import read_xy
+
+    if compression == "zstd":
+        zstandard = pytest.importorskip("zstandard")
+    args = args_train_tmpdir
+    main(args)
+    train_dir = os.path.join(args.data_dir, "train")
+    with open(os.path.join(train_dir, "train_features.csv"), "rb") as f:
+        expected = f.read()
+    X_expected, y_expected = read_xy(train_dir)
+
+    monkeypatch.setattr(preprocessing, "write_block_rows", 50)
+    args.write_jobs = 4
+    args.compression = compression
+    for subdir in ["train", "test"]:
+        shutil.rmtree(os.path.join(args.data_dir, subdir))
+        os.mkdir(os.path.join(args.data_dir, subdir))
+    main(args)
+    suffix = {None: "", "gzip": ".gz", "zstd": ".zst"}[compression]
+    with open(os.path.join(train_dir, "train_features.csv" + suffix), "rb") as f:
+        data = f.read()
+    if compression == "gzip":
+        data = gzip.decompress(data)
+    elif compression == "zstd":
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            io.BytesIO(data), read_across_frames=True
+        )
+        data = reader.read()
+    assert data == expected
+
+    X, y = read_xy(train_dir)
+    pd.testing.assert_frame_equal(X, X_expected)
+    pd.testing.assert_frame_equal(y, y_expected)
+
+
+@dt.working_directory(__file__)
+def test_compiled_preprocessing(args_train_tmpdir):
+    args = args_train_tmpdir
+    expected, _ = main(args)
+    args.compiled = True
+    train_features, _ = main(args)
+    assert os.path.exists(os.path.join(args.data_dir, "model/proc_compiled.npz"))
+    np.testing.assert_allclose(train_features, expected)
+
+    args.mode = "infer"
+    infer_features = main(args)
+    assert infer_features.shape[1] == expected.shape[1]
+
+
 @dt.working_directory(__file__)
 def test_parse_arg():
     args = parse_arg()
@@ -69,4 +838,11 @@ def test_parse_arg():
     assert args.data_dir == "opt/ml/processing"
     assert args.data_input == "input/census-income.csv"
 
+
+def test_parse_arg_csv_engine(monkeypatch):
+    """Only the read_csv engines of the pinned pandas are accepted."""
+    monkeypatch.setattr("sys.argv", ["preprocessing.py", "--csv-engine", "pyarrow"])
+    with pytest.raises(SystemExit):
+        parse_arg()
+
 # To do: need to clean the folders created
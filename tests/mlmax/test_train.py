@@ -1,13 +1,32 @@
 import os
+import json
+import socket
+import shutil
+import tarfile
+import multiprocessing
 import pytest
 import argparse
 import pandas as pd
+import numpy as np
 import datatest as dt
 
+try:
+    from sklearn.externals import joblib
+except ImportError:
+    import joblib
+
+from mlmax.preprocessing import write_data
 from mlmax.train import (
+    chunk_specs,
+    connect_hosts,
+    read_chunk,
+    read_chunk_labels,
+    read_shards,
     read_xy,
     read_processed_data,
+    search,
     train,
+    train_chunks,
     evaluate,
     save_model,
     parse_arg,
@@ -22,6 +41,28 @@ def args():
     parser.add_argument("--train", type=str, default="opt/ml/processing/train")
     parser.add_argument("--test", type=str, default="opt/ml/processing/test")
     parser.add_argument("--model-dir", type=str, default="opt/ml/model")
+    parser.add_argument("--feature-format", type=str, default="csv")
+    parser.add_argument("--dtype", type=str, default="float64")
+    parser.add_argument("--mmap", action="store_true")
+    parser.add_argument("--hosts", type=json.loads, default="[]")
+    parser.add_argument("--current-host", type=str, default=None)
+    parser.add_argument("--averaging-host", type=str, default=None)
+    parser.add_argument("--averaging-port", type=int, default=29500)
+    parser.add_argument("--averaging-rounds", type=int, default=1)
+    parser.add_argument("--averaging-token", type=str, default=None)
+    parser.add_argument("--local-max-iter", type=int, default=100)
+    parser.add_argument("--warm-start-model", type=str, default=None)
+    parser.add_argument("--compare-cold-start", action="store_true")
+    parser.add_argument("--estimators", type=str, nargs="+", default=None)
+    parser.add_argument("--search", action="store_true")
+    parser.add_argument("--search-jobs", type=int, default=2)
+    parser.add_argument("--halving-factor", type=int, default=3)
+    parser.add_argument("--chunksize", type=int, default=None)
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--tol", type=float, default=1e-4)
+    parser.add_argument("--n-iter-no-change", type=int, default=1)
+    parser.add_argument("--checkpoint-dir", type=str, default=None)
+    parser.add_argument("--checkpoint-every", type=int, default=1)
     args, _ = parser.parse_known_args()
     os.makedirs(args.model_dir, exist_ok=True)
     print(f"Received arguments {args}")
@@ -53,6 +94,64 @@ def test_read_xy(test_train_data_path):
     dt.validate(y_test.iloc[:, 0], required_labels)
 
 
+@pytest.mark.parametrize("feature_format", ["csv", "npy", "parquet", "feather"])
+@dt.working_directory(__file__)
+def test_read_xy_feature_format(test_train_data_path, feature_format, tmpdir):
+    """
+    Features written by preprocessing in any format read back unchanged.
+    """
+    if feature_format in ("parquet", "feather"):
+        pytest.importorskip("pyarrow")
+    train_path, _ = test_train_data_path
+    X_expected, y_expected = read_xy(train_path)
+    write_args = argparse.Namespace(
+        data_dir=str(tmpdir), feature_format=feature_format, compression=None
+    )
+    write_data(X_expected.values, write_args, "train_features.csv")
+    write_data(y_expected.iloc[:, 0], write_args, "train_labels.csv")
+
+    X, y = read_xy(str(tmpdir), "train", feature_format)
+    assert isinstance(X, pd.DataFrame)
+    pd.testing.assert_frame_equal(X, X_expected, check_dtype=False)
+    pd.testing.assert_frame_equal(y, y_expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("feature_format", ["npy", "feather"])
+@dt.working_directory(__file__)
+def test_read_xy_mmap(test_train_data_path, feature_format, tmpdir):
+    """
+    Memory-mapped reads return C-contiguous arrays, npy ones without a copy.
+    """
+    if feature_format == "feather":
+        pytest.importorskip("pyarrow")
+    train_path, _ = test_train_data_path
+    X_expected, y_expected = read_xy(train_path)
+    write_args = argparse.Namespace(
+        data_dir=str(tmpdir), feature_format=feature_format, compression=None
+    )
+    write_data(X_expected.values, write_args, "train_features.csv")
+    write_data(y_expected.iloc[:, 0], write_args, "train_labels.csv")
+
+    X, y = read_xy(str(tmpdir), "train", feature_format, mmap=True)
+    assert isinstance(X, np.ndarray) and X.flags["C_CONTIGUOUS"]
+    assert isinstance(X, np.memmap) == (feature_format == "npy")
+    assert y.ndim == 1
+    np.testing.assert_allclose(X, X_expected.values)
+    np.testing.assert_array_equal(y, y_expected.iloc[:, 0].values)
+    model = train(X, y, None)
+    assert model.coef_.shape == (1, X.shape[1])
+
+
+@dt.working_directory(__file__)
+def test_read_xy_float32(test_train_data_path):
+    train_path, _ = test_train_data_path
+    X_expected, y_expected = read_xy(train_path)
+    X, y = read_xy(train_path, dtype="float32")
+    assert (X.dtypes == np.float32).all()
+    np.testing.assert_allclose(X.values, X_expected.values, rtol=1e-6)
+    pd.testing.assert_frame_equal(y, y_expected)
+
+
 @dt.working_directory(__file__)
 def test_read_processed_data(args):
     """
@@ -73,6 +172,126 @@ def test_train(args):
     # todo: add an assert statement
 
 
+@dt.working_directory(__file__)
+def test_train_warm_start(args, tmpdir):
+    X_train, y_train, _, _ = read_processed_data(args)
+    cold_model = train(X_train, y_train, args)
+    model_path = os.path.join(str(tmpdir), "model.joblib")
+    joblib.dump(cold_model, model_path)
+    tar_path = os.path.join(str(tmpdir), "model.tar.gz")
+    with tarfile.open(tar_path, "w:gz") as archive:
+        archive.add(model_path, arcname="model.joblib")
+
+    args.warm_start_model = tar_path
+    args.compare_cold_start = True
+    model = train(X_train, y_train, args)
+    assert model.warm_start
+    assert model.n_iter_.max() < cold_model.n_iter_.max()
+    np.testing.assert_allclose(model.coef_, cold_model.coef_, atol=1e-3)
+
+    # A model of another feature layout falls back to a cold start
+    joblib.dump(train(X_train.iloc[:, 1:], y_train, None), model_path)
+    args.warm_start_model = model_path
+    model = train(X_train, y_train, args)
+    assert not model.warm_start
+    assert model.n_iter_.max() == cold_model.n_iter_.max()
+
+
+@pytest.mark.parametrize("averaging_rounds", [1, 3])
+@dt.working_directory(__file__)
+def test_main_data_parallel(args, tmpdir, averaging_rounds):
+    """
+    Two processes standing in for hosts train on halves of the training
+    data, and the first saves the row-weighted average of their models.
+    """
+    X_train, y_train, _, _ = read_processed_data(args)
+    halves = [slice(0, 100), slice(100, None)]
+    write_args = argparse.Namespace(feature_format="csv", compression=None)
+    for i, rows in enumerate(halves):
+        write_args.data_dir = str(tmpdir.mkdir(f"train-{i + 1}"))
+        write_data(X_train.values[rows], write_args, "train_features.csv")
+        write_data(y_train.values[rows], write_args, "train_labels.csv")
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+
+    def host_args(host):
+        host_args = argparse.Namespace(**vars(args))
+        host_args.train = str(tmpdir.join(f"train-{host[-1]}"))
+        host_args.model_dir = str(tmpdir)
+        host_args.hosts = ["algo-1", "algo-2"]
+        host_args.current_host = host
+        host_args.averaging_host = "localhost"
+        host_args.averaging_port = port
+        host_args.averaging_token = "test-token"
+        host_args.averaging_rounds = averaging_rounds
+        host_args.local_max_iter = 100 if averaging_rounds == 1 else 10
+        return host_args
+
+    other_host = multiprocessing.get_context("fork").Process(
+        target=main, args=(host_args("algo-2"),)
+    )
+    other_host.start()
+    main(host_args("algo-1"))
+    other_host.join(timeout=60)
+    assert other_host.exitcode == 0
+
+    model = joblib.load(str(tmpdir.join("model.joblib")))
+    shard_models = [train(X_train[rows], y_train[rows], None) for rows in halves]
+    weights = [100, X_train.shape[0] - 100]
+    expected = np.average([m.coef_ for m in shard_models], axis=0, weights=weights)
+    if averaging_rounds == 1:
+        np.testing.assert_allclose(model.coef_, expected)
+    else:
+        assert model.coef_.shape == expected.shape
+        assert set(model.predict(X_train)) == {0, 1}
+
+
+def test_read_shards_no_data(tmpdir):
+    """A host that received only empty shards, or none, fails clearly."""
+    tmpdir.join("part-00000.csv").write("")
+    with pytest.raises(ValueError, match="No non-empty"):
+        read_shards(str(tmpdir), "train")
+
+
+def test_connect_hosts_timeout(args, monkeypatch):
+    """The first host stops waiting for hosts that never connect."""
+    monkeypatch.setattr("mlmax.train.averaging_connect_timeout", 0.1)
+    args.hosts = ["algo-1", "algo-2"]
+    args.current_host = "algo-1"
+    args.averaging_host = "localhost"
+    args.averaging_port = 0
+    with pytest.raises(ValueError, match="--averaging-token"):
+        connect_hosts(args)
+    args.averaging_token = "test-token"
+    with pytest.raises(TimeoutError, match="0 of 1 hosts"):
+        connect_hosts(args)
+
+
+def test_connect_hosts_wrong_token(args, monkeypatch):
+    """A host with another token is rejected, and the first host waits on."""
+    monkeypatch.setattr("mlmax.train.averaging_connect_timeout", 2)
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+    args.hosts = ["algo-1", "algo-2"]
+    args.averaging_host = "localhost"
+    args.averaging_port = port
+    other_args = argparse.Namespace(**vars(args))
+    other_args.current_host = "algo-2"
+    other_args.averaging_token = "other-token"
+    other_host = multiprocessing.get_context("fork").Process(
+        target=connect_hosts, args=(other_args,)
+    )
+    other_host.start()
+    args.current_host = "algo-1"
+    args.averaging_token = "test-token"
+    with pytest.raises(TimeoutError, match="0 of 1 hosts"):
+        connect_hosts(args)
+    other_host.join(timeout=10)
+    assert other_host.exitcode != 0
+
+
 @dt.working_directory(__file__)
 def test_evaluate(load_joblib_model, args):
     X_train, y_train, X_test, y_test = read_processed_data(args)
@@ -94,6 +313,174 @@ def test_main(args):
     main(args)
 
 
+@dt.working_directory(__file__)
+def test_search(args):
+    X_train, y_train, _, _ = read_processed_data(args)
+    model, report = search(X_train, y_train, args)
+    rounds = report["rounds"]
+    assert len(rounds[0]["candidates"]) == report["n_candidates"]
+    # Each round keeps a third of the candidates on three times the rows
+    for previous, current in zip(rounds, rounds[1:]):
+        assert len(current["candidates"]) == -(-len(previous["candidates"]) // 3)
+        assert current["n_rows"] >= previous["n_rows"]
+    assert rounds[-1]["n_rows"] == X_train.shape[0] - int(X_train.shape[0] * 0.2)
+    assert report["best_params"] in [c["params"] for c in rounds[-1]["candidates"]]
+    assert model.get_params()["C"] == report["best_params"]["C"]
+
+
+@dt.working_directory(__file__)
+def test_main_estimators(args, tmpdir):
+    args.model_dir = str(tmpdir)
+    args.estimators = ["lr", "sgd"]
+    main(args)
+    with open(os.path.join(args.model_dir, "leaderboard.json")) as f:
+        leaderboard = json.load(f)
+    assert {entry["estimator"] for entry in leaderboard} == {"lr", "sgd"}
+    roc_aucs = [entry["validation_roc_auc"] for entry in leaderboard]
+    assert roc_aucs == sorted(roc_aucs, reverse=True)
+    for entry in leaderboard:
+        assert 0 <= entry["test_roc_auc"] <= 1
+        assert entry["fit_seconds"] == pytest.approx(
+            entry["validation_fit_seconds"] + entry["refit_seconds"]
+        )
+        assert os.path.exists(os.path.join(args.model_dir, entry["artifact"]))
+    best = joblib.load(os.path.join(args.model_dir, "model.joblib"))
+    assert type(best).__name__ == {"lr": "LogisticRegression", "sgd": "SGDClassifier"}[
+        leaderboard[0]["estimator"]
+    ]
+
+
+@dt.working_directory(__file__)
+def test_train_chunks_resume(args, tmpdir, monkeypatch):
+    """
+    Training interrupted mid-epoch resumes from its checkpoint to the same
+    model as an uninterrupted run.
+    """
+    args.chunksize = 100
+    args.epochs = 3
+    args.n_iter_no_change = args.epochs
+    expected, _ = train_chunks(args)
+
+    args.checkpoint_dir = str(tmpdir)
+    n_reads = []
+
+    def interrupted_read_chunk(*read_args):
+        # After 3 training and 4 test chunks per epoch, this stops on the
+        # second chunk of the second epoch
+        n_reads.append(None)
+        if len(n_reads) == 9:
+            raise KeyboardInterrupt
+        return read_chunk(*read_args)
+
+    monkeypatch.setattr("mlmax.train.read_chunk", interrupted_read_chunk)
+    with pytest.raises(KeyboardInterrupt):
+        train_chunks(args)
+    state = joblib.load(str(tmpdir.join("checkpoint.joblib")))
+    assert (state["epoch"], state["offset"]) == (1, 1)
+
+    monkeypatch.undo()
+    model, _ = train_chunks(args)
+    np.testing.assert_array_equal(model.coef_, expected.coef_)
+    np.testing.assert_array_equal(model.intercept_, expected.intercept_)
+    assert joblib.load(str(tmpdir.join("checkpoint.joblib")))["epoch"] == args.epochs
+
+
+@dt.working_directory(__file__)
+def test_train_chunks_stale_checkpoint(args, tmpdir, monkeypatch):
+    """
+    A finished checkpoint of other training arguments or data is not resumed.
+    """
+    args.chunksize = 100
+    args.epochs = 2
+    args.checkpoint_dir = str(tmpdir)
+    train_dir = tmpdir.mkdir("train")
+    for name in ["train_features.csv", "train_labels.csv"]:
+        shutil.copy(os.path.join(args.train, name), str(train_dir))
+    args.train = str(train_dir)
+    train_chunks(args)
+    assert joblib.load(str(tmpdir.join("checkpoint.joblib")))["epoch"] == args.epochs
+
+    n_reads = []
+
+    def counted_read_chunk(*read_args):
+        n_reads.append(None)
+        return read_chunk(*read_args)
+
+    monkeypatch.setattr("mlmax.train.read_chunk", counted_read_chunk)
+    train_chunks(args)
+    assert not n_reads
+
+    # Another dataset of the same size, with the rows in reverse order
+    for name in ["train_features.csv", "train_labels.csv"]:
+        lines = train_dir.join(name).readlines()
+        train_dir.join(name).write("".join(lines[::-1]))
+    train_chunks(args)
+    assert n_reads
+
+    n_reads.clear()
+    args.tol = 1e-3
+    train_chunks(args)
+    assert n_reads
+
+
+@dt.working_directory(__file__)
+def test_main_search(args, tmpdir):
+    args.model_dir = str(tmpdir)
+    args.search = True
+    main(args)
+    assert os.path.exists(os.path.join(args.model_dir, "model.joblib"))
+    with open(os.path.join(args.model_dir, "search_report.json")) as f:
+        assert "best_params" in json.load(f)
+
+
+@dt.working_directory(__file__)
+def test_read_chunk(test_train_data_path):
+    """
+    Chunks of the training data are read in any order and reassemble it.
+    """
+    train_path, _ = test_train_data_path
+    X_train, y_train = read_xy(train_path)
+    specs = chunk_specs(train_path, "train", "csv", 100)
+    assert len(specs) == -(-X_train.shape[0] // 100)
+    chunks = [read_chunk(spec) for spec in reversed(specs)][::-1]
+    np.testing.assert_allclose(np.vstack([X for X, _ in chunks]), X_train.values)
+    np.testing.assert_array_equal(
+        np.concatenate([y for _, y in chunks]), y_train.iloc[:, 0].values
+    )
+    labels = [read_chunk_labels(spec) for spec in specs]
+    np.testing.assert_array_equal(np.concatenate(labels), y_train.iloc[:, 0].values)
+
+
+@dt.working_directory(__file__)
+def test_read_chunk_labels_shards(test_train_data_path, tmpdir):
+    """
+    The labels of shards, which hold them in their first column, are read
+    without their features.
+    """
+    train_path, _ = test_train_data_path
+    X_train, y_train = read_xy(train_path)
+    shard = pd.concat([y_train, X_train], axis=1)
+    shard.to_csv(str(tmpdir.join("part-00000.csv")), header=False, index=False)
+    specs = chunk_specs(str(tmpdir), "train", "csv", 100)
+    assert all(labels_path is None for _, labels_path, _, _ in specs)
+    labels = np.concatenate([read_chunk_labels(spec) for spec in specs])
+    np.testing.assert_array_equal(labels, y_train.iloc[:, 0].values)
+
+
+@dt.working_directory(__file__)
+def test_main_chunks(args, tmpdir):
+    args.model_dir = str(tmpdir)
+    args.chunksize = 100
+    args.epochs = 3
+    args.checkpoint_dir = str(tmpdir.mkdir("checkpoints"))
+    main(args)
+    assert not os.listdir(args.checkpoint_dir)
+    model = joblib.load(os.path.join(args.model_dir, "model.joblib"))
+    assert model.loss == "log"
+    X_test, _ = read_xy(args.test, "test")
+    assert set(model.predict(X_test)) <= {0, 1}
+
+
 @dt.working_directory(__file__)
 def test_parse_arg():
     args = parse_arg()